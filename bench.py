@@ -0,0 +1,213 @@
+import sys
+import time
+import queue
+import random
+import argparse
+import itertools
+import tempfile
+import threading
+from collections import defaultdict
+from telegram import Bot, Update
+from gekkonbot import bot as gekkonbot
+from gekkonbot.fakes import FakeSheets, FakeTelegram
+
+
+TOKEN = "123456:FAKE-TOKEN"
+
+
+def percentile(values, q):
+    """
+    :param values: Sorted list
+    :param q: Percentile (0-100)
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def make_tables(categories, items, destinations):
+    """
+    :return: Content of fake spreadsheets and list of destination names
+    """
+    catalog = []
+    code = 1000
+    for c in range(categories):
+        catalog.append(["Категория: Категория {}".format(c)])
+        for i in range(items):
+            code += 1
+            catalog.append(["", str(code), 'Пленка "Позиция {}-{}" 100x200'.format(c, i)])
+    names = ["Школа №{} {}".format(i, random.choice(["Москва", "Химки", "Королев", "Долгопрудный"]))
+             for i in range(destinations)]
+    tables = {
+        'catalog': {'Номенклатура': [["header"]] + catalog},
+        'orders': {'Orders': [["id", "артикул", "название", "количество", "имя", "дата"], ["00001"]]},
+        'destinations': {'Площадки': [["header"]] + [[name] for name in names]}
+    }
+    return tables, names
+
+
+def make_config(data_dir):
+    return {
+        'telegram-token': TOKEN,
+        'catalog': {'table': 'catalog', 'sheet': 'Номенклатура', 'range': 'A2:C'},
+        'orders': {'table': 'orders', 'sheet': 'Orders', 'range': 'A:F', 'id-range': 'A2:A'},
+        'destinations': {'table': 'destinations', 'sheet': 'Площадки', 'range': 'A2:A'},
+        'notification-chat': -1,
+        'welcome-message': "",
+        'notification-interval': 0,
+        'flood-control': {'user-rate': 0, 'chat-rate': 0},  # simulated users are much faster than real ones
+        'data-dir': data_dir
+    }
+
+
+class Driver:
+    """
+    Feeds updates to the dispatcher one by one from single thread, like Dispatcher.start does
+    """
+
+    def __init__(self, updater):
+        self.updater = updater
+        self.bot = updater.bot
+        self.queue = queue.Queue()
+        self.latencies = defaultdict(list)  # step: [seconds]
+        self._update_ids = itertools.count(1)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            step, data, done = task
+            update = Update.de_json(data, self.bot)
+            start = time.perf_counter()
+            self.updater.dispatcher.process_update(update)
+            self.latencies[step].append(time.perf_counter() - start)
+            done.set()
+
+    def send(self, step, data):
+        """
+        Process update and wait for it
+        """
+        data['update_id'] = next(self._update_ids)
+        done = threading.Event()
+        self.queue.put((step, data, done))
+        done.wait()
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+
+
+class User:
+    """
+    Simulated staff member, who places orders
+    """
+
+    def __init__(self, user_id, driver, tables, destinations):
+        self.user_id = user_id
+        self.driver = driver
+        self.catalog = tables['catalog']['Номенклатура']
+        self.destinations = destinations
+        self.message_id = 0
+
+    def _from(self):
+        return {'id': self.user_id, 'first_name': "User{}".format(self.user_id), 'is_bot': False,
+                'username': "user{}".format(self.user_id)}
+
+    def message(self, step, text):
+        self.message_id += 1
+        self.driver.send(step, {'message': {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': self._from(),
+            'text': text
+        }})
+
+    def callback(self, step, data):
+        self.driver.send(step, {'callback_query': {
+            'id': str(random.getrandbits(32)),
+            'from': self._from(),
+            'chat_instance': str(self.user_id),
+            'message': {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': self.user_id, 'type': 'private'},
+                'text': ""
+            },
+            'data': data
+        }})
+
+    def order(self):
+        category = random.randrange(len(gekkonbot.ic.get_categories()))
+        code = random.choice(gekkonbot.ic.get_category(category))[0]
+        destination = random.choice(self.destinations)
+        dst_hash = gekkonbot.dl.search(destination)[0][1]
+        self.message('order', '/order')
+        self.callback('category', str(category))
+        self.callback('item', str(code))
+        self.callback('confirm', 'next')
+        self.message('count', str(random.randint(1, 100)))
+        self.message('deadline', "23.02")
+        self.message('destination', destination.split()[0] + " " + destination.split()[1])
+        self.callback('destination_choice', dst_hash)
+        self.callback('comment', 'skip')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of order conversation on fake Sheets and Telegram")
+    parser.add_argument('--users', type=int, default=20, help="simulated users ordering at once")
+    parser.add_argument('--orders', type=int, default=10, help="orders per user")
+    parser.add_argument('--sheets-latency', type=float, default=0, help="Sheets request latency, ms")
+    parser.add_argument('--telegram-latency', type=float, default=0, help="Telegram request latency, ms")
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--items', type=int, default=50, help="items per category")
+    parser.add_argument('--destinations', type=int, default=3000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    tables, destinations = make_tables(args.categories, args.items, args.destinations)
+    sheets = FakeSheets(tables, latency=args.sheets_latency / 1000)
+    telegram = FakeTelegram(latency=args.telegram_latency / 1000)
+    with tempfile.TemporaryDirectory() as data_dir:
+        updater = gekkonbot.init(make_config(data_dir), client=sheets, bot=Bot(TOKEN, request=telegram))
+        gekkonbot.dl.loaded.wait()  # users pick destinations from the loaded list
+        driver = Driver(updater)
+        users = [User(100 + i, driver, tables, destinations) for i in range(args.users)]
+
+        def run(user):
+            for i in range(args.orders):
+                user.order()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        driver.stop()
+        gekkonbot.stop_services(None, None)
+
+    orders = args.users * args.orders
+    print("Orders: {} in {:.2f}s, {:.1f} orders/s".format(orders, elapsed, orders / elapsed))
+    print("{:<20} {:>7} {:>9} {:>9} {:>9}".format("handler", "count", "p50 ms", "p95 ms", "p99 ms"))
+    total = []
+    for step, latencies in driver.latencies.items():
+        latencies.sort()
+        total.extend(latencies)
+        print("{:<20} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format(step, len(latencies), percentile(latencies, 50) * 1000,
+                                                              percentile(latencies, 95) * 1000,
+                                                              percentile(latencies, 99) * 1000))
+    total.sort()
+    print("{:<20} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format("all", len(total), percentile(total, 50) * 1000,
+                                                          percentile(total, 95) * 1000, percentile(total, 99) * 1000))
+    print("Sheets calls: {}".format(dict(sheets.calls)))
+    print("Telegram calls: {}".format(dict(telegram.calls)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,26 @@
+import io
 import os
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
-from telegram.ext import Updater, CommandHandler, ConversationHandler, CallbackQueryHandler, RegexHandler, MessageHandler
+import time
+import datetime as dt
+from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, \
+    ParseMode
+from telegram.ext import Updater, CommandHandler, ConversationHandler, CallbackQueryHandler, RegexHandler, MessageHandler, \
+    InlineQueryHandler, TypeHandler
 from telegram.ext.filters import InvertedFilter, Filters
-from .spreadsheets import ItemsCatalog, OrderList, DestinationList, get_credentials
+from .metrics import metrics
+from .persistence import SQLitePersistence, PersistentConversationHandler, setup_persistence, \
+    CONVERSATION_TTL
+from .scheduler import RequestScheduler, READ_QUOTA, WRITE_QUOTA
+from .recent import RecentStore, RECENT_SIZE, MAX_USERS
+from .notifications import Notifier, WORKERS as NOTIFICATION_WORKERS, CHAT_INTERVAL as NOTIFICATION_INTERVAL
+from .report import parse_period, get_report, format_text, format_csv
+from .recorder import UpdateRecorder, setup_recorder
+from .flood import FloodControl, setup_flood_control, USER_RATE, CHAT_RATE, SHED_QUEUE
+from .shards import get_journals, shard_of
+from .snapshot import SnapshotFile
+from .spreadsheets import SheetsClient, ItemsCatalog, OrderList, DestinationList, get_credentials, preload, \
+    UPDATE_DELAY, MIRROR_DELAY, POOL_SIZE, MSK_TZ
 
 
 class Text:
@@ -16,13 +34,54 @@ class Text:
     CHOOSE_COUNT = "_Укажите количество (только цифрами):_"
     SET_DEADLINE = "_Введите дату дедлайна (в формате 23.02):_"
     SET_COMMENT = "Введите комментарий к заказу _(опционально)_:"
+    NO_ORDER_IDS = "Не удалось получить номер заказа: нет связи с Google Таблицами. Попробуйте оформить заказ позже"
     DONE = "Заказ №{} на *{}* {}шт успешно создан.\nДедлайн: {}\nНазначение: {}\nКомментарий: {}"
     ABORTED = "_Оформление заказа отменено_"
     PRODUCTION = "Заказ №{}\n*[{}] {} {}шт*\nСотрудник: `{}`\nДедлайн: {}\nНазначение: {}\nКомментарий: {}"
+    DONE_CART = "Заказы успешно созданы:\n{}\nДедлайн: {}\nНазначение: {}\nКомментарий: {}"
+    DONE_LINE = "№{} *{}* {}шт"
+    PRODUCTION_CART = "Заказы №{}-{}\n{}\nСотрудник: `{}`\nДедлайн: {}\nНазначение: {}\nКомментарий: {}"
+    PRODUCTION_LINE = "№{} *[{}] {} {}шт*"
+    ADD_ITEM = "➕ Добавить позицию"
     SET_DESTINATION = "Введите поисковый запрос для выбора площадки-назначения:"
+    NO_LAST_ORDER = "Нет предыдущего заказа для повтора. Для оформления заказа отправьте /order"
+    REPEAT = "_Повтор заказа:_\n*{}*\n{}\nНазначение: {}"
+    UNKNOWN_ITEM = "Позиция не найдена в каталоге"
+    MY_ORDERS = "Ваши последние заказы:\n{}"
+    MY_ORDER_LINE = "№{} *{}* {}шт от {}\nСтатус: {}"
+    NO_STATUS = "принят"
+    NO_ORDERS = "У вас пока нет заказов"
+    STATUS_CHANGED = "Статус заказа №{} *{}* {}шт: {}"
+    SHEETS_OK = "Google Sheets: доступны"
+    SHEETS_DEGRADED = "Google Sheets: недоступны с {} ({})\nБот работает по сохраненной копии каталога, " \
+                      "заказы копятся в локальном журнале"
+    SHEETS_RECOVERED = "Google Sheets снова доступны"
+    STATUS = "{}\nКаталог: версия {}, загружен {} ({} мин назад)\nПлощадки: загружены {} ({} мин назад)\n" \
+             "Заказы, ожидающие записи в таблицу: {}"
+    FORCEUPDATE_THROTTLED = "Обновление уже запускалось недавно, повторите через {} с"
+    FLOOD = "Слишком много запросов, подождите немного"
+    REPORT_USAGE = "Использование: /report [с 01.03] [по 31.03] [csv]"
     DESTINATION_LIST = "По запросу *{}* найдено площадок: {}. Повторите поиск, если нужная площадка не найдена."
 
 
+WORKERS = 4  # dispatcher threads
+MESSAGE_LIMIT = 4096
+INLINE_RESULTS = 50  # Telegram limit
+INLINE_CACHE_TIME = 300  # seconds
+LOAD_TIMEOUT = 10  # seconds, handlers wait for sheets still loading after start
+DESTINATION_DEBOUNCE = 3  # seconds, destination search sent sooner edits previous results
+FORCEUPDATE_INTERVAL = 60  # seconds between forced catalog updates
+MY_ORDERS_LIMIT = 10
+PAGE_SIZE = 40  # buttons on one page of keyboard
+PAGE_PREFIX = "page:"
+ITEM_PREFIX = "item:"
+BOOT_GROUP = 101  # after persistence
+_menus = {'version': None}  # InlineKeyboardMarkup cache for current catalog version
+SNAPSHOT_POLL = 5  # seconds, how often worker processes check for new catalog snapshot
+_forceupdate = {'last': -FORCEUPDATE_INTERVAL}  # monotonic time of last forced update
+_boot = {'started': None, 'first_response': None}  # monotonic time of init start, seconds until first answer
+
+
 class State:
     """
     Enum of states
@@ -40,22 +99,59 @@ def put_order(bot, update, user_data, callback=False):
     deadline = user_data['deadline']
     count = user_data['count']
     item = ic.get(user_data['category'], user_data['item'])
-    dl.update_recent(user_data['destination'])
     dst = dl.get(user_data['destination'])
     comment = user_data['comment']
     query_or_update = update.message if not callback else update.callback_query
     name = query_or_update.from_user.name
-    order_id = ol.new(item, count, name, deadline, dst, comment)
-    query_or_update = update if not callback else update.callback_query
-    query_or_update.message.reply_text(Text.DONE.format(order_id, item[1], count, deadline, dst, comment),
-                                       parse_mode=ParseMode.MARKDOWN)
+    categories = [user_data['category']]
+    lines = []
+    for code, line_count in user_data.pop('cart', []):  # items added before current one
+        line_category, line_item = ic.find(code)
+        categories.append(line_category)
+        lines.append((line_item, line_count))
+    lines.append((item, count))
     try:
-        bot.send_message(text=Text.PRODUCTION.format(order_id, item[0], item[1], count, name, deadline, dst, comment),
-                         chat_id=PRODUCTION_CHAT_ID, parse_mode=ParseMode.MARKDOWN)
-    except Exception:
-        print("Can't send message to notification chat")
-
-
+        order_ids = ol.new_batch(lines, name, deadline, dst, comment, customer_id=query_or_update.from_user.id)
+    except Exception as e:  # ids were never synced with the sheet and it is unavailable
+        print("Can't allocate order ids: ", e)
+        query_or_update = update if not callback else update.callback_query
+        query_or_update.message.reply_text(Text.NO_ORDER_IDS)
+        return
+    for line_item, line_count in lines:
+        recent.add_order(query_or_update.from_user.id, line_item.code, user_data['destination'])
+    query_or_update = update if not callback else update.callback_query
+    if len(lines) == 1:
+        done = Text.DONE.format(order_ids[0], item[1], count, deadline, dst, comment)
+        production = Text.PRODUCTION.format(order_ids[0], item[0], item[1], count, name, deadline, dst, comment)
+    else:
+        done = Text.DONE_CART.format(
+            "\n".join(Text.DONE_LINE.format(order_id, line_item[1], line_count)
+                      for order_id, (line_item, line_count) in zip(order_ids, lines)),
+            deadline, dst, comment)
+        production = Text.PRODUCTION_CART.format(
+            order_ids[0], order_ids[-1],
+            "\n".join(Text.PRODUCTION_LINE.format(order_id, line_item[0], line_item[1], line_count)
+                      for order_id, (line_item, line_count) in zip(order_ids, lines)),
+            name, deadline, dst, comment)
+    query_or_update.message.reply_text(done, parse_mode=ParseMode.MARKDOWN)
+    notifier.notify(production, get_notification_chats(categories))
+
+
+def get_notification_chats(categories):
+    """
+    :param categories: Category ids of ordered items
+    :return: List of chats to notify about order
+    """
+    chats = [PRODUCTION_CHAT_ID]
+    catalog = ic.all()
+    for category in categories:
+        title = catalog[category].title
+        if title in CATEGORY_CHATS:
+            chats.append(CATEGORY_CHATS[title])
+    return chats
+
+
+@metrics.handler
 def start_command(bot, update):
     """
     Initial information for user
@@ -63,38 +159,94 @@ def start_command(bot, update):
     update.message.reply_text(START_MSG)
 
 
-def order_command(bot, update, user_data):
+@metrics.handler
+def order_command(bot, update, user_data, args=None):
     """
     Start ordering process
-    """
-    message = update.message.reply_text(Text.CHOOSE_CATEGORY, reply_markup=get_category_menu(),
-                                        parse_mode=ParseMode.MARKDOWN)
+    With item code (sent by inline query result) skip to count step
+    """
+    user_data.pop('repeat', None)
+    user_data['cart'] = []
+    if args:
+        try:
+            user_data['category'], item = ic.find(int(args[0]))
+        except (ValueError, KeyError):
+            update.message.reply_text(Text.UNKNOWN_ITEM)
+            return ConversationHandler.END
+        user_data['item'] = item.code
+        update.message.reply_text(Text.CONFIRMED_ITEM.format(item.name, item.description),
+                                  parse_mode=ParseMode.MARKDOWN)
+        update.message.reply_text(Text.CHOOSE_COUNT, parse_mode=ParseMode.MARKDOWN)
+        return State.CHOOSE_COUNT
+    menu = get_category_menu()
+    recent_items = get_recent_items_rows(update.message.from_user.id)
+    if recent_items:
+        menu = InlineKeyboardMarkup(recent_items + menu.inline_keyboard)
+    message = update.message.reply_text(Text.CHOOSE_CATEGORY, reply_markup=menu, parse_mode=ParseMode.MARKDOWN)
     user_data['keyboard_message'] = message.message_id
+    user_data['category_page'] = 0
     return State.CHOOSE_CATEGORY
 
 
+@metrics.handler
+def repeat_command(bot, update, user_data):
+    """
+    Start order with item and destination of previous order
+    """
+    last = recent.last_order(update.message.from_user.id)
+    try:
+        category, item = ic.find(last['item'])
+        dst = dl.get(last['destination'])
+    except (TypeError, KeyError, IndexError):  # no orders or item/destination is gone
+        update.message.reply_text(Text.NO_LAST_ORDER)
+        return ConversationHandler.END
+    user_data.update(category=category, item=item.code, destination=last['destination'], comment="", repeat=True,
+                     cart=[])
+    update.message.reply_text(Text.REPEAT.format(item.name, item.description, dst), parse_mode=ParseMode.MARKDOWN)
+    update.message.reply_text(Text.CHOOSE_COUNT, parse_mode=ParseMode.MARKDOWN)
+    return State.CHOOSE_COUNT
+
+
+@metrics.handler
 def category_callback(bot, update, user_data):
     """
     Choose category and show available items
     """
     query = update.callback_query
     bot.answer_callback_query(query.id)  # To stop loading circles on buttons
+    if query.data.startswith(PAGE_PREFIX):
+        turn_page(bot, query, user_data, 'category_page', get_category_menu)
+        return State.CHOOSE_CATEGORY
+    if query.data.startswith(ITEM_PREFIX):  # recent item
+        user_data['category'], item = ic.find(int(query.data[len(ITEM_PREFIX):]))
+        user_data['item'] = item.code
+        user_data['page'] = 0
+        bot.edit_message_text(text=Text.CONFIRM_ITEM.format(item[0], item[1], item[2]), reply_markup=get_confirm_menu(),
+                              chat_id=query.message.chat_id, message_id=query.message.message_id,
+                              parse_mode=ParseMode.MARKDOWN)
+        return State.CONFIRM_ITEM
     user_data['category'] = int(query.data)
+    user_data['page'] = 0
     bot.edit_message_text(text=Text.CHOOSE_ITEM, reply_markup=get_items_menu(user_data['category']),
                           chat_id=query.message.chat_id, message_id=query.message.message_id,
                           parse_mode=ParseMode.MARKDOWN)
     return State.CHOOSE_ITEM
 
 
+@metrics.handler
 def items_callback(bot, update, user_data):
     """
     Choose item and show description
     """
     query = update.callback_query
     bot.answer_callback_query(query.id)  # To stop loading circles on buttons
+    if query.data.startswith(PAGE_PREFIX):
+        turn_page(bot, query, user_data, 'page', lambda page: get_items_menu(user_data['category'], page))
+        return State.CHOOSE_ITEM
     if 'back' in query.data.lower():
         del user_data['category']
-        bot.edit_message_text(text=Text.CHOOSE_CATEGORY, reply_markup=get_category_menu(),
+        bot.edit_message_text(text=Text.CHOOSE_CATEGORY,
+                              reply_markup=get_category_menu(user_data.get('category_page', 0)),
                               chat_id=query.message.chat_id, message_id=query.message.message_id,
                               parse_mode=ParseMode.MARKDOWN)
         return State.CHOOSE_CATEGORY
@@ -106,6 +258,7 @@ def items_callback(bot, update, user_data):
     return State.CONFIRM_ITEM
 
 
+@metrics.handler
 def confirm_item_callback(bot, update, user_data):
     """
     Confirm or reject item
@@ -114,7 +267,8 @@ def confirm_item_callback(bot, update, user_data):
     bot.answer_callback_query(query.id)  # To stop loading circles on buttons
     if 'back' in query.data.lower():
         del user_data['item']
-        bot.edit_message_text(text=Text.CHOOSE_ITEM, reply_markup=get_items_menu(user_data['category']),
+        bot.edit_message_text(text=Text.CHOOSE_ITEM,
+                              reply_markup=get_items_menu(user_data['category'], user_data.get('page', 0)),
                               chat_id=query.message.chat_id, message_id=query.message.message_id,
                               parse_mode=ParseMode.MARKDOWN)
         return State.CHOOSE_ITEM
@@ -129,49 +283,95 @@ def confirm_item_callback(bot, update, user_data):
         return State.CHOOSE_COUNT
 
 
+@metrics.handler
 def count_handler(bot, update, user_data):
     """
     Read items count
     """
     user_data['count'] = int(update.message.text)
-    update.message.reply_text(text=Text.SET_DEADLINE, parse_mode=ParseMode.MARKDOWN)
+    message = update.message.reply_text(text=Text.SET_DEADLINE, reply_markup=get_cart_menu(),
+                                        parse_mode=ParseMode.MARKDOWN)
+    user_data['keyboard_message'] = message.message_id
     return State.SET_DEADLINE
 
 
+@metrics.handler
+def add_item_callback(bot, update, user_data):
+    """
+    Put chosen item into cart and choose one more
+    """
+    query = update.callback_query
+    bot.answer_callback_query(query.id)  # To stop loading circles on buttons
+    user_data.setdefault('cart', []).append([user_data.pop('item'), user_data.pop('count')])
+    bot.edit_message_text(text=Text.CHOOSE_CATEGORY, reply_markup=get_category_menu(),
+                          chat_id=query.message.chat_id, message_id=query.message.message_id,
+                          parse_mode=ParseMode.MARKDOWN)
+    user_data['keyboard_message'] = query.message.message_id
+    user_data['category_page'] = 0
+    return State.CHOOSE_CATEGORY
+
+
+@metrics.handler
 def deadline_handler(bot, update, user_data):
     """
     Read order deadline
     """
     user_data['deadline'] = update.message.text
-    message = update.message.reply_text(text=Text.SET_DESTINATION, reply_markup=get_destinations_menu(dl.get_recent()),
+    if 'keyboard_message' in user_data:  # remove cart button
+        bot.edit_message_text(text=Text.SET_DEADLINE, chat_id=update.message.chat_id,
+                              message_id=user_data['keyboard_message'], parse_mode=ParseMode.MARKDOWN)
+        del user_data['keyboard_message']
+    if user_data.pop('repeat', False):  # destination and comment are known
+        put_order(bot, update, user_data)
+        return ConversationHandler.END
+    recent_destinations = get_recent_destinations(update.message.from_user.id)
+    message = update.message.reply_text(text=Text.SET_DESTINATION,
+                                        reply_markup=get_destinations_menu(recent_destinations),
                                         parse_mode=ParseMode.MARKDOWN)
-    if len(dl.get_recent()) > 0:
+    if len(recent_destinations) > 0:
         user_data['keyboard_message'] = message.message_id
     user_data['destination_results'] = None
     return State.SET_DESTINATION
 
 
+@metrics.handler
 def destination_handler(bot, update, user_data):
     """
     Read query and show search results
-    """
+    Repeated query is ignored, rapid queries update previous results instead of sending new message
+    """
+    query_text = update.message.text
+    shown = user_data.get('destination_results', None) is not None and 'keyboard_message' in user_data
+    if shown and user_data['destination_results'][0] == query_text:
+        return
+    dl.loaded.wait(LOAD_TIMEOUT)  # destinations are loaded in background after start
+    results = dl.search(query_text)
+    text = Text.DESTINATION_LIST.format(query_text, len(results))
+    markup = get_destinations_menu(results[:16])
+    if shown and time.time() - user_data.get('destination_time', 0) < DESTINATION_DEBOUNCE:
+        user_data['destination_results'] = (query_text, len(results))
+        user_data['destination_time'] = time.time()
+        bot.edit_message_text(text=text, chat_id=update.message.chat_id, message_id=user_data['keyboard_message'],
+                              reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+        return
+
     if 'keyboard_message' in user_data:  # more beautiful solution?
         if user_data.get('destination_results', None) is None:
-            text = Text.SET_DESTINATION
+            previous = Text.SET_DESTINATION
         else:
-            text = Text.DESTINATION_LIST.format(*user_data['destination_results'])
-        bot.edit_message_text(text=text, chat_id=update.message.chat_id,
+            previous = Text.DESTINATION_LIST.format(*user_data['destination_results'])
+        bot.edit_message_text(text=previous, chat_id=update.message.chat_id,
                               message_id=user_data['keyboard_message'], parse_mode=ParseMode.MARKDOWN)
         del user_data['keyboard_message']
 
-    results = dl.search(update.message.text)
-    user_data['destination_results'] = (update.message.text, len(results))
-    message = update.message.reply_text(text=Text.DESTINATION_LIST.format(update.message.text, len(results)),
-                                        reply_markup=get_destinations_menu(results[:16]), parse_mode=ParseMode.MARKDOWN)
+    user_data['destination_results'] = (query_text, len(results))
+    user_data['destination_time'] = time.time()
+    message = update.message.reply_text(text=text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
     if len(results) > 0:
         user_data['keyboard_message'] = message.message_id
 
 
+@metrics.handler
 def destination_callback(bot, update, user_data):
     query = update.callback_query
     bot.answer_callback_query(query.id)  # To stop loading circles on buttons
@@ -192,6 +392,7 @@ def destination_callback(bot, update, user_data):
     return State.SET_COMMENT
 
 
+@metrics.handler
 def comment_handler(bot, update, user_data):
     """
     Read order comment
@@ -206,6 +407,7 @@ def comment_handler(bot, update, user_data):
     return ConversationHandler.END
 
 
+@metrics.handler
 def comment_callback(bot, update, user_data):
     """
     Read order comment
@@ -222,6 +424,7 @@ def comment_callback(bot, update, user_data):
     return ConversationHandler.END
 
 
+@metrics.handler
 def abort_command(bot, update, user_data):
     """
     Abort ordering process
@@ -230,10 +433,51 @@ def abort_command(bot, update, user_data):
         bot.edit_message_text(text=Text.ABORTED, chat_id=update.message.chat_id,
                               message_id=user_data['keyboard_message'], parse_mode=ParseMode.MARKDOWN)
         del user_data['keyboard_message']
+    user_data.pop('cart', None)
     update.message.reply_text("Заказ прерван")
     return ConversationHandler.END
 
 
+@metrics.handler
+def inline_query_handler(bot, update):
+    """
+    Search items in whole catalog
+    """
+    query = update.inline_query
+    results = []
+    codes = set()  # code may repeat in several categories, but Telegram rejects answer with duplicate ids
+    for category, item in ic.search(query.query):
+        if item.code in codes:
+            continue
+        if len(results) == INLINE_RESULTS:
+            break
+        codes.add(item.code)
+        results.append(InlineQueryResultArticle(
+            id=str(item.code), title=item.name, description="[{}] {}".format(item.code, item.description),
+            input_message_content=InputTextMessageContent("/order {}".format(item.code))
+        ))
+    bot.answer_inline_query(query.id, results, cache_time=INLINE_CACHE_TIME)
+
+
+@metrics.handler
+def myorders_command(bot, update):
+    """
+    Send latest orders of user with their statuses from local copy of orders sheet
+    """
+    user = update.message.from_user
+    orders = ol.mirror.by_customer(user.id, user.name, limit=MY_ORDERS_LIMIT)
+    if not len(orders):
+        update.message.reply_text(Text.NO_ORDERS)
+        return
+    lines = []
+    for order_id, name, count, created, status in orders:
+        status = ", ".join(x for x in status if x) or Text.NO_STATUS
+        lines.append(Text.MY_ORDER_LINE.format("{:05}".format(order_id), name, count, created, status))
+    text = Text.MY_ORDERS.format("\n\n".join(lines))
+    update.message.reply_text(text[:MESSAGE_LIMIT], parse_mode=ParseMode.MARKDOWN)
+
+
+@metrics.handler
 def chatid_command(bot, update):
     """
     Send chat id
@@ -242,15 +486,192 @@ def chatid_command(bot, update):
     bot.send_message(text="chat_id: {}".format(chat_id), chat_id=chat_id)
 
 
-def forceupdate_command(bot, update):
+@metrics.handler
+def forceupdate_command(bot, update, job_queue):
+    """
+    Force update of catalog, available to admins not more often than once in FORCEUPDATE_INTERVAL
+    """
+    if update.message.from_user.id not in ADMINS:
+        return
+    wait = _forceupdate['last'] + FORCEUPDATE_INTERVAL - time.monotonic()
+    if wait > 0:
+        bot.send_message(text=Text.FORCEUPDATE_THROTTLED.format(int(wait) + 1), chat_id=update.message.chat_id)
+        return
+    _forceupdate['last'] = time.monotonic()
+    job_queue.run_once(refresh_job, 0, context=update.message.chat_id)
+    bot.send_message(text="Обновление базы запущено", chat_id=update.message.chat_id)
+
+
+@metrics.handler
+def stats_command(bot, update):
+    """
+    Send metrics summary to admin
+    """
+    if update.message.from_user.id not in ADMINS:
+        return
+    text = metrics.summary() or "Нет данных"
+    bot.send_message(text=text[:MESSAGE_LIMIT], chat_id=update.message.chat_id)
+
+
+@metrics.handler
+def status_command(bot, update):
+    """
+    Send state of Google Sheets connection and freshness of catalog to admin
+    """
+    if update.message.from_user.id not in ADMINS:
+        return
+    if sheets.degraded_since is None:
+        health = Text.SHEETS_OK
+    else:
+        health = Text.SHEETS_DEGRADED.format(format_time(sheets.degraded_since), sheets.last_error)
+    now = dt.datetime.now().timestamp()
+    text = Text.STATUS.format(health, ic.version, format_time(ic.last_update), int(now - ic.last_update) // 60,
+                              format_time(dl.last_update), int(now - dl.last_update) // 60,
+                              sum(len(journal.pending()) for journal in ol.journals))
+    bot.send_message(text=text[:MESSAGE_LIMIT], chat_id=update.message.chat_id)
+
+
+@metrics.handler
+def report_command(bot, update, args=None):
+    """
+    Send totals of orders by item, destination and employee to admin
+    /report [first date] [last date] [csv]
+    """
+    if update.message.from_user.id not in ADMINS:
+        return
+    args = list(args or [])
+    as_csv = 'csv' in args
+    if as_csv:
+        args.remove('csv')
+    try:
+        first_day, last_day = parse_period(args, dt.datetime.now(tz=MSK_TZ).date())
+    except ValueError:
+        update.message.reply_text(Text.REPORT_USAGE)
+        return
+    report = get_report(ol.mirror, first_day, last_day)
+    if as_csv:
+        bot.send_document(chat_id=update.message.chat_id, document=io.BytesIO(format_csv(report)),
+                          filename="report_{:%Y%m%d}_{:%Y%m%d}.csv".format(first_day, last_day))
+    else:
+        update.message.reply_text(format_text(report, first_day, last_day)[:MESSAGE_LIMIT])
+
+
+def format_time(timestamp):
+    return dt.datetime.fromtimestamp(timestamp, tz=MSK_TZ).strftime("%d.%m.%Y %H:%M")
+
+
+def notify_health_change(degraded):
+    """
+    Tell admins when Google Sheets becomes unavailable or recovers
+    """
+    metrics.inc('sheets_health_changes_total', degraded=degraded)
+    if degraded:
+        text = Text.SHEETS_DEGRADED.format(format_time(sheets.degraded_since), sheets.last_error)
+    else:
+        text = Text.SHEETS_RECOVERED
+    notifier.notify(text, ADMINS)
+
+
+def refresh_job(bot, job):
+    """
+    Reload catalog and destinations in background
+    Handlers keep using previous snapshot until reload finishes
+    """
+    try:
+        ic.refresh()
+        dl.refresh()
+        snapshot.save(get_cached_sheets())
+    except Exception as e:
+        print("Can't refresh catalog: ", e)
+        if job.context is not None:
+            bot.send_message(text="Не удалось обновить базу", chat_id=job.context)
+        return
+    if job.context is not None:
+        bot.send_message(text="База успешно обновлена", chat_id=job.context)
+
+
+def follow_snapshot_job(bot, job):
+    """
+    Reload catalog and destinations saved by another process
+    """
+    try:
+        snapshot.load(get_cached_sheets())
+    except Exception as e:
+        print("Can't load catalog snapshot: ", e)
+
+
+def get_cached_sheets():
+    return {'catalog': ic, 'destinations': dl}
+
+
+def sync_job(bot, job):
     """
-    Force update of catalog
+    Pull new rows and changed statuses of orders into local copy and notify customers about status changes,
+    move order ids counter past ids added to the sheet by hand
     """
-    ic.last_update = 0
-    ic.all()
-    dl.last_update = 0
-    dl.all()
-    bot.send_message(text="База успешно обновлена", chat_id=update.message.chat_id)
+    if sheets.degraded_since is None:  # while Sheets is down local state is enough to keep ids unique
+        try:
+            ol.ids.reconcile()
+        except Exception as e:
+            print("Can't reconcile order ids with the sheet: ", e)
+    try:
+        changed = ol.sync()
+    except Exception as e:
+        print("Can't sync orders: ", e)
+        return
+    metrics.inc('status_changes_total', len(changed))
+    for order_id, customer_id, name, count, status in changed:
+        if customer_id is None:  # placed before customer ids were stored or not by this bot
+            continue
+        status = ", ".join(x for x in status if x) or Text.NO_STATUS
+        notifier.notify(Text.STATUS_CHANGED.format("{:05}".format(order_id), name, count, status), [customer_id])
+
+
+def first_response_handler(bot, update):
+    """
+    Measure time from start of init until the first update is handled
+    """
+    if _boot['first_response'] is None:
+        _boot['first_response'] = time.monotonic() - _boot['started']
+        print("First update handled in {:.2f}s after start".format(_boot['first_response']))
+
+
+def log_preload_error(name):
+    """
+    :return: Future callback, which prints error of background loading
+    """
+    def callback(future):
+        if future.exception() is not None:
+            print("Can't load {}: {}".format(name, future.exception()))
+    return callback
+
+
+def save_snapshot_after(futures):
+    """
+    Save snapshot as soon as all sheets are loaded
+    :param futures: Futures of sheets loading
+    """
+    def callback(future):
+        if all(x.done() and x.exception() is None for x in futures):
+            snapshot.save(get_cached_sheets())
+    for future in set(futures):
+        future.add_done_callback(callback)
+
+
+def get_request_kwargs(config):
+    """
+    :param config: Config dictionary
+    :return: Telegram request kwargs
+    """
+    request_kwargs = {}
+    # proxy setup
+    if 'proxy' in config:
+        request_kwargs['proxy_url'] = config['proxy']['url']
+        request_kwargs['urllib3_proxy_kwargs'] = {
+            'username': config['proxy']['user'],
+            'password': config['proxy']['password']
+        }
+    return request_kwargs
 
 
 def error_handler(bot, update, telegram_error):
@@ -258,36 +679,138 @@ def error_handler(bot, update, telegram_error):
     Error handler (seriously?!)
     """
     print("Error occured: ", telegram_error)
+    metrics.inc('telegram_errors_total', error=type(telegram_error).__name__)
+
+
+def stop_services(signum, frame):
+    """
+    Flush local buffers before exit
+    """
+    ol.close()
+    notifier.stop()
+    persistence.close()
+    recent.close()
+    if recorder is not None:
+        recorder.close()
+
+
+def turn_page(bot, query, user_data, page_key, get_menu):
+    """
+    Show another page of paged keyboard
+    :param page_key: user_data key of current page
+    :param get_menu: Callable(page), returns InlineKeyboardMarkup
+    """
+    page = int(query.data[len(PAGE_PREFIX):])
+    if page == user_data.get(page_key, 0):  # page counter button
+        return
+    user_data[page_key] = page
+    bot.edit_message_reply_markup(reply_markup=get_menu(page), chat_id=query.message.chat_id,
+                                  message_id=query.message.message_id)
 
 
-def get_category_menu():
+def cached_menu(key, version, build):
     """
+    :param key: Menu key
+    :param version: Version of data, menu is built from
+    :param build: Callable, returns InlineKeyboardMarkup
+    :return: InlineKeyboardMarkup
+    """
+    global _menus
+    menus = _menus  # read once to survive concurrent invalidation
+    if menus['version'] != version:
+        menus = {'version': version}
+        _menus = menus
+    if key not in menus:
+        metrics.inc('menu_cache_total', result='miss')
+        menus[key] = build()
+    else:
+        metrics.inc('menu_cache_total', result='hit')
+    return menus[key]
+
+
+def paginate(buttons, page, columns, extra_rows=()):
+    """
+    :param buttons: List of InlineKeyboardButton
+    :param page: Page number
+    :param columns: Buttons in a row
+    :param extra_rows: Rows added after navigation row
+    :return: InlineKeyboardMarkup
+    """
+    pages = max(1, (len(buttons) + PAGE_SIZE - 1) // PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    page_buttons = buttons[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+    keyboard = [page_buttons[i:i + columns] for i in range(0, len(page_buttons), columns)]
+    if pages > 1:
+        keyboard.append([
+            InlineKeyboardButton("‹", callback_data=PAGE_PREFIX + str((page - 1) % pages)),
+            InlineKeyboardButton("{}/{}".format(page + 1, pages), callback_data=PAGE_PREFIX + str(page)),
+            InlineKeyboardButton("›", callback_data=PAGE_PREFIX + str((page + 1) % pages))
+        ])
+    keyboard.extend(extra_rows)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_category_menu(page=0):
+    """
+    :param page: Page number
     :return:  InlineKeyboardMarkup
     """
-    categories = ic.get_categories()
-    keyboard = []
-    for i, title in categories:
-        keyboard.append([InlineKeyboardButton(title, callback_data=str(i))])
-    markup = InlineKeyboardMarkup(keyboard)
-    return markup
+    def build():
+        categories = ic.get_categories()
+        buttons = [InlineKeyboardButton(title, callback_data=str(i)) for i, title in categories]
+        return paginate(buttons, page, 1)
+
+    return cached_menu(('categories', page), ic.version, build)
 
 
-def get_items_menu(category):
+def get_items_menu(category, page=0):
     """
     :param category: Category id
+    :param page: Page number
     :return: InlineKeyboardMarkup
     """
-    subcatalog = ic.get_category(category)
-    keyboard = []
-    for i in range(len(subcatalog)):
-        button = InlineKeyboardButton(subcatalog[i][1], callback_data=str(subcatalog[i][0]))
-        if i % 2:
-            keyboard[-1].append(button)
-        else:
-            keyboard.append([button])
-    keyboard.append([InlineKeyboardButton("Назад", callback_data="back")])
-    markup = InlineKeyboardMarkup(keyboard)
-    return markup
+    def build():
+        subcatalog = ic.get_category(category)
+        buttons = [InlineKeyboardButton(item[1], callback_data=str(item[0])) for item in subcatalog]
+        return paginate(buttons, page, 2, [[InlineKeyboardButton("Назад", callback_data="back")]])
+
+    return cached_menu(('items', category, page), ic.version, build)
+
+
+def get_recent_items_rows(user_id):
+    """
+    :param user_id: Telegram user id
+    :return: Keyboard rows with recent items of user
+    """
+    buttons = []
+    for code in recent.items(user_id):
+        try:
+            category, item = ic.find(code)
+        except KeyError:  # removed from catalog
+            continue
+        buttons.append(InlineKeyboardButton("↻ " + item.name, callback_data=ITEM_PREFIX + str(code)))
+    return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+
+
+def get_recent_destinations(user_id):
+    """
+    :param user_id: Telegram user id
+    :return: List of recent destinations of user [(name, md5 hash)]
+    """
+    destinations = []
+    for dst_hash in recent.destinations(user_id):
+        try:
+            destinations.append((dl.get(dst_hash), dst_hash))
+        except IndexError:  # removed from list
+            continue
+    return destinations
+
+
+def get_cart_menu():
+    """
+    :return: InlineKeyboardMarkup
+    """
+    return InlineKeyboardMarkup([[InlineKeyboardButton(Text.ADD_ITEM, callback_data="add")]])
 
 
 def get_confirm_menu():
@@ -322,39 +845,86 @@ def get_comment_menu():
     return markup
 
 
-def init(config):
+def init(config, client=None, bot=None, shard=None):
     """
     :param config: Config dictionary
+    :param client: SheetsClient, created from config if not set
+    :param bot: telegram.Bot, created from config if not set
+    :param shard: (index, count) of worker process, None if bot runs in single process
     :return: Updated object
     """
-    global ic, ol, dl, PRODUCTION_CHAT_ID, START_MSG
-    credentials = get_credentials(config['google-credentials-path'])
-    ic = ItemsCatalog(credentials, config['catalog'])
-    ol = OrderList(credentials, config['orders'])
-    dl = DestinationList(credentials, config['destinations'])
+    global ic, ol, dl, sheets, notifier, persistence, recent, snapshot, recorder, PRODUCTION_CHAT_ID, CATEGORY_CHATS, \
+        START_MSG, ADMINS
+    _boot['started'] = time.monotonic()
+    os.makedirs(config['data-dir'], exist_ok=True)
+    if client is None:
+        credentials = get_credentials(config['google-credentials-path'])
+        client = SheetsClient(credentials, config['data-dir'], pool_size=config.get('google-pool-size', POOL_SIZE))
+    quota = config.get('sheets-quota', {})
+    client = sheets = RequestScheduler(client, read_quota=quota.get('read', READ_QUOTA),
+                                       write_quota=quota.get('write', WRITE_QUOTA))
+    # the first process reads sheets in background jobs, others follow its snapshot
+    leader = shard is None or shard[0] == 0
+    journal_name, orphans = get_journals(config['data-dir'], shard)
+    ic = ItemsCatalog(client, config['catalog'])
+    ol = OrderList(client, config['orders'], config['data-dir'], journal_name=journal_name, orphans=orphans)
+    dl = DestinationList(client, config['destinations'])
+    # saved copy of sheets is loaded before any request, so bot can start while Google Sheets is unavailable
+    snapshot = SnapshotFile(os.path.join(config['data-dir'], 'sheets.snapshot'))
+    from_snapshot = snapshot.load(get_cached_sheets())
+    if from_snapshot:
+        print("Catalog version from {} loaded from snapshot".format(format_time(ic.last_update)))
+    if not leader and from_snapshot:
+        loading = preload(client, [], tasks=[ol.ids.reconcile])
+    else:
+        loading = preload(client, [ic, dl], tasks=[ol.ids.reconcile])
+    loading[ol.ids.reconcile].add_done_callback(log_preload_error("order ids"))
     PRODUCTION_CHAT_ID = config['notification-chat']
+    CATEGORY_CHATS = config.get('category-chats', {})
     START_MSG = config['welcome-message']
+    ADMINS = config.get('admins', [])
 
-    request_kwargs = {}
-    # proxy setup
-    if 'proxy' in config:
-        request_kwargs['proxy_url'] = config['proxy']['url']
-        request_kwargs['urllib3_proxy_kwargs'] = {
-            'username': config['proxy']['user'],
-            'password': config['proxy']['password']
-        }
-
-    updater = Updater(config['telegram-token'], request_kwargs=request_kwargs)
+    if bot is None:
+        updater = Updater(config['telegram-token'], workers=config.get('workers', WORKERS),
+                          request_kwargs=get_request_kwargs(config), user_sig_handler=stop_services)
+    else:
+        updater = Updater(bot=bot, workers=config.get('workers', WORKERS), user_sig_handler=stop_services)
+    notifier = Notifier(updater.bot, workers=config.get('notification-workers', NOTIFICATION_WORKERS),
+                        chat_interval=config.get('notification-interval', NOTIFICATION_INTERVAL))
+    notifier.start()
+    sheets.on_health_change = notify_health_change
+    recorder = None
+    if 'record' in config:
+        path = config['record'].get('path', os.path.join(config['data-dir'], 'updates.jsonl.gz'))
+        if shard is not None:
+            path = "{}.{}".format(path, shard[0])
+        recorder = UpdateRecorder(path, keep_text=config['record'].get('keep-text', False))
+        setup_recorder(updater.dispatcher, recorder)
+    flood = config.get('flood-control', {})
+    setup_flood_control(updater.dispatcher, FloodControl(user_rate=flood.get('user-rate', USER_RATE),
+                                                         chat_rate=flood.get('chat-rate', CHAT_RATE),
+                                                         shed_queue=flood.get('shed-queue', SHED_QUEUE)), Text.FLOOD)
     updater.dispatcher.add_handler(CommandHandler('start', start_command, filters=InvertedFilter(Filters.group)))
     # Order process
-    conversation_handler = ConversationHandler(
-        entry_points=[CommandHandler('order', order_command, filters=InvertedFilter(Filters.group), pass_user_data=True)],
+    persistence = SQLitePersistence(os.path.join(config['data-dir'], 'state.sqlite3'),
+                                    ttl=config.get('conversation-ttl', CONVERSATION_TTL))
+    setup_persistence(updater.dispatcher, persistence)
+    recent = RecentStore(os.path.join(config['data-dir'], 'recent.sqlite3'),
+                         size=config.get('recent-size', RECENT_SIZE), max_users=config.get('recent-users', MAX_USERS),
+                         owner=None if shard is None else lambda user_id: shard_of(user_id, shard[1]) == shard[0])
+    conversation_handler = PersistentConversationHandler(
+        'order', persistence,
+        entry_points=[CommandHandler('order', order_command, filters=InvertedFilter(Filters.group), pass_user_data=True,
+                                     pass_args=True),
+                      CommandHandler('repeat', repeat_command, filters=InvertedFilter(Filters.group),
+                                     pass_user_data=True)],
         states={
             State.CHOOSE_CATEGORY: [CallbackQueryHandler(category_callback, pass_user_data=True)],
             State.CHOOSE_ITEM:     [CallbackQueryHandler(items_callback, pass_user_data=True)],
             State.CONFIRM_ITEM:    [CallbackQueryHandler(confirm_item_callback, pass_user_data=True)],
             State.CHOOSE_COUNT:    [RegexHandler(r"^[0-9]+$", count_handler, pass_user_data=True)],
-            State.SET_DEADLINE:    [RegexHandler(r"^[0-9]{1,2}\.[0-9]{2}$", deadline_handler, pass_user_data=True)],
+            State.SET_DEADLINE:    [RegexHandler(r"^[0-9]{1,2}\.[0-9]{2}$", deadline_handler, pass_user_data=True),
+                                    CallbackQueryHandler(add_item_callback, pattern='^add$', pass_user_data=True)],
             State.SET_DESTINATION: [MessageHandler(Filters.text, destination_handler, pass_user_data=True),
                                     CallbackQueryHandler(destination_callback, pass_user_data=True)],
             State.SET_COMMENT:     [MessageHandler(Filters.text, comment_handler, pass_user_data=True),
@@ -363,8 +933,39 @@ def init(config):
         fallbacks=[CommandHandler('abort', abort_command, filters=InvertedFilter(Filters.group), pass_user_data=True)]
     )
     updater.dispatcher.add_handler(conversation_handler)
+    updater.dispatcher.add_handler(InlineQueryHandler(inline_query_handler))
+    updater.dispatcher.add_handler(CommandHandler('myorders', myorders_command, filters=InvertedFilter(Filters.group)))
     updater.dispatcher.add_handler(CommandHandler('chatid', chatid_command))
-    updater.dispatcher.add_handler(CommandHandler('forceupdate', forceupdate_command))
+    updater.dispatcher.add_handler(CommandHandler('forceupdate', forceupdate_command, pass_job_queue=True))
+    updater.dispatcher.add_handler(CommandHandler('stats', stats_command))
+    updater.dispatcher.add_handler(CommandHandler('status', status_command))
+    updater.dispatcher.add_handler(CommandHandler('report', report_command, pass_args=True))
+
+    if leader:
+        update_interval = config.get('update-interval', UPDATE_DELAY)
+        updater.job_queue.run_repeating(refresh_job, update_interval, first=update_interval)
+        updater.job_queue.run_repeating(sync_job, config['orders'].get('sync-interval', MIRROR_DELAY), first=0)
+    else:
+        updater.job_queue.run_repeating(follow_snapshot_job, SNAPSHOT_POLL, first=SNAPSHOT_POLL)
 
     updater.dispatcher.add_error_handler(error_handler)
+
+    updater.dispatcher.add_handler(TypeHandler(Update, first_response_handler), group=BOOT_GROUP)
+
+    if ic in loading:
+        if not from_snapshot:
+            loading[ic].result()  # handlers need catalog from the first update
+        # destinations and order ids are needed only in the end of order, so bot doesn't wait for them
+        loading[ic].add_done_callback(log_preload_error("catalog"))
+        loading[dl].add_done_callback(log_preload_error("destinations"))
+        save_snapshot_after([loading[ic], loading[dl]])
+    print("Catalog loaded in {:.2f}s after start".format(time.monotonic() - _boot['started']))
+    metrics.gauge('time_to_first_response_seconds', lambda: _boot['first_response'] or 0)
+    metrics.gauge('update_queue_depth', updater.update_queue.qsize)
+    metrics.gauge('notification_queue_depth', notifier.depth)
+    metrics.gauge('orders_journal_pending', lambda: len(ol.journal.pending()))
+    metrics.gauge('sheets_degraded', lambda: int(sheets.degraded_since is not None))
+    metrics.gauge('catalog_age_seconds', lambda: int(dt.datetime.now().timestamp() - ic.last_update))
+    if 'metrics' in config and leader:
+        metrics.serve(config['metrics'].get('listen', '127.0.0.1'), config['metrics']['port'])
     return updater
@@ -7,3 +7,4 @@ with open(os.path.join(CONFIG_DIR, 'config.json'), 'r', encoding='utf-8') as con
     config = json.loads(config_file.read())
 
 config['google-credentials-path'] = os.path.join(CONFIG_DIR, 'google_service.json')
+config.setdefault('data-dir', os.path.join(CONFIG_DIR, 'data'))
@@ -0,0 +1,160 @@
+import re
+import json
+import time
+import threading
+from collections import Counter
+
+
+A1_RE = re.compile(r"^([A-Z]*)([0-9]*)(?::([A-Z]*)([0-9]*))?$")
+
+
+def column_number(letters):
+    """
+    :param letters: Column letters, e.g. "AB"
+    :return: Zero-based column number
+    """
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number - 1
+
+
+def parse_range(a1_range):
+    """
+    :param a1_range: Range in A1 notation, e.g. "Orders!A2:F"
+    :return: (sheet, first row, last row or None, first column, last column or None), zero-based
+    """
+    sheet, cells = a1_range.rsplit('!', 1)
+    first_col, first_row, last_col, last_row = A1_RE.match(cells).groups()
+    return (sheet,
+            int(first_row) - 1 if first_row else 0,
+            int(last_row) - 1 if last_row else None,
+            column_number(first_col) if first_col else 0,
+            column_number(last_col) if last_col else None)
+
+
+class FakeSheetsRequest:
+    """
+    Stand-in for apiclient HttpRequest
+    """
+
+    def __init__(self, sheets, method, kwargs):
+        self.sheets = sheets
+        self.method = method
+        self.methodId = 'sheets.spreadsheets.values.' + method
+        self.kwargs = kwargs
+        self.uri = "{}?{}".format(method, json.dumps(kwargs, sort_keys=True, ensure_ascii=False))
+        self.body = None
+
+    def execute(self, http=None):
+        return self.sheets.execute(self)
+
+
+class FakeSheets:
+    """
+    In-process stand-in for SheetsClient, implements values().get/batchGet/append of Sheets API v4
+    """
+
+    def __init__(self, tables, latency=0):
+        """
+        :param tables: Dict {spreadsheet id: {sheet name: rows}}
+        :param latency: Delay of every request (seconds)
+        """
+        self.tables = tables
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.service = self
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, **kwargs):
+        return FakeSheetsRequest(self, 'get', kwargs)
+
+    def batchGet(self, **kwargs):
+        return FakeSheetsRequest(self, 'batchGet', kwargs)
+
+    def append(self, **kwargs):
+        return FakeSheetsRequest(self, 'append', kwargs)
+
+    def read(self, spreadsheet_id, a1_range):
+        """
+        :return: Values of range with trailing empty rows removed, like Sheets API does
+        """
+        sheet, first_row, last_row, first_col, last_col = parse_range(a1_range)
+        rows = self.tables[spreadsheet_id][sheet]
+        end = len(rows) if last_row is None else last_row + 1
+        values = [list(row[first_col:None if last_col is None else last_col + 1]) for row in rows[first_row:end]]
+        while values and not any(values[-1]):
+            values.pop()
+        return {'range': a1_range, 'values': values} if values else {'range': a1_range}
+
+    def execute(self, request):
+        """
+        :param request: FakeSheetsRequest
+        :return: Response
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        kwargs = request.kwargs
+        with self._lock:
+            self.calls[request.method] += 1
+            if request.method == 'get':
+                return self.read(kwargs['spreadsheetId'], kwargs['range'])
+            if request.method == 'batchGet':
+                return {'valueRanges': [self.read(kwargs['spreadsheetId'], a1_range) for a1_range in kwargs['ranges']]}
+            sheet = parse_range(kwargs['range'])[0]
+            rows = self.tables[kwargs['spreadsheetId']][sheet]
+            rows.extend(kwargs['body']['values'])
+            return {'updates': {'updatedRows': len(kwargs['body']['values'])}}
+
+
+class FakeTelegram:
+    """
+    In-process stand-in for telegram.utils.request.Request, answers Bot API methods used by the bot
+    """
+    con_pool_size = 64
+
+    def __init__(self, latency=0, username='fake_gekkon_bot'):
+        """
+        :param latency: Delay of every request (seconds)
+        :param username: Bot username
+        """
+        self.latency = latency
+        self.username = username
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def _message(self, data):
+        with self._lock:
+            self._message_id += 1
+            message_id = data.get('message_id', self._message_id)
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': data.get('chat_id', 0), 'type': 'private'},
+            'text': data.get('text', '')
+        }
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+        if method == 'getMe':
+            return {'id': 1, 'first_name': 'Gekkon', 'is_bot': True, 'username': self.username}
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument'):
+            return self._message(data)
+        return True
+
+    def get(self, url, timeout=None):
+        return self.post(url, {}, timeout)
+
+    def stop(self):
+        pass
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+from telegram import Update
+from telegram.ext import TypeHandler, DispatcherHandlerStop
+from .metrics import metrics
+from .scheduler import TokenBucket
+
+
+USER_RATE = 30  # updates per minute, 0 to disable
+CHAT_RATE = 60
+SHED_QUEUE = 50  # dispatcher queue depth, above which low priority updates are dropped
+MAX_BUCKETS = 10000  # least recently active users and chats are forgotten above this
+FLOOD_GROUP = -1  # before all handlers
+LOW_PRIORITY_COMMANDS = ('/myorders', '/stats', '/status', '/chatid', '/report')
+
+
+class FloodControl:
+    """
+    Admission control in front of handlers: per-user and per-chat token buckets,
+    low priority updates are dropped while dispatcher queue is saturated
+    """
+
+    def __init__(self, user_rate=USER_RATE, chat_rate=CHAT_RATE, shed_queue=SHED_QUEUE):
+        """
+        :param user_rate: Updates per minute from one user
+        :param chat_rate: Updates per minute from one chat
+        :param shed_queue: Dispatcher queue depth, above which low priority updates are dropped
+        """
+        self.rates = {'user': user_rate, 'chat': chat_rate}
+        self.shed_queue = shed_queue
+        self._lock = threading.Lock()
+        self._buckets = {'user': OrderedDict(), 'chat': OrderedDict()}
+        self._warned = set()  # users, who were already told that their updates are dropped
+
+    def _take(self, kind, key):
+        """
+        :return: True if update from key is allowed
+        """
+        rate = self.rates[kind]
+        if not rate or key is None:
+            return True
+        buckets = self._buckets[kind]
+        bucket = buckets.pop(key, None) or TokenBucket(rate)
+        buckets[key] = bucket
+        while len(buckets) > MAX_BUCKETS:
+            buckets.popitem(last=False)
+        return bucket.take() == 0
+
+    def allow(self, user_id, chat_id):
+        """
+        :return: (allowed, warn) - warn is True for the first dropped update of user
+        """
+        with self._lock:
+            if self._take('user', user_id) and self._take('chat', chat_id):
+                self._warned.discard(user_id)
+                return True, False
+            warn = user_id not in self._warned
+            self._warned.add(user_id)
+            return False, warn
+
+    @staticmethod
+    def is_low_priority(update):
+        """
+        Updates, which can be dropped without breaking order process
+        """
+        if update.inline_query is not None or update.chosen_inline_result is not None:
+            return True
+        message = update.message
+        if message is None or not message.text:
+            return False
+        return message.text.split(' ')[0].split('@')[0] in LOW_PRIORITY_COMMANDS
+
+
+def setup_flood_control(dispatcher, flood, notice):
+    """
+    Drop updates before they reach handlers
+    :param dispatcher: telegram.ext.Dispatcher
+    :param flood: FloodControl
+    :param notice: Text sent to user once, when his updates start being dropped
+    """
+    def check(bot, update):
+        if flood.shed_queue and dispatcher.update_queue.qsize() > flood.shed_queue and flood.is_low_priority(update):
+            metrics.inc('updates_shed_total')
+            raise DispatcherHandlerStop()
+        user = update.effective_user
+        chat = update.effective_chat
+        allowed, warn = flood.allow(user.id if user is not None else None, chat.id if chat is not None else None)
+        if allowed:
+            return
+        metrics.inc('updates_throttled_total')
+        if update.callback_query is not None:  # stop loading circle on button
+            bot.answer_callback_query(update.callback_query.id, text=notice if warn else None)
+        elif warn and update.message is not None:
+            update.message.reply_text(notice)
+        raise DispatcherHandlerStop()
+
+    dispatcher.add_handler(TypeHandler(Update, check), group=FLOOD_GROUP)
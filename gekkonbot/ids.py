@@ -0,0 +1,114 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+
+
+ID_BLOCK_SIZE = 20
+
+
+class IdAllocator:
+    """
+    Allocates unique order ids for all threads and processes sharing the same state file
+    Every process leases block of ids from the state file and hands them out from memory
+    Counter is synced with the sheet by reconcile from background jobs, so ordering never waits for Sheets
+    """
+
+    def __init__(self, path, reader, block_size=ID_BLOCK_SIZE):
+        """
+        :param path: Path to state file
+        :param reader: Callable(offset), returns (max id, rows count) for id column starting from offset row
+        :param block_size: Number of ids leased at once
+        """
+        self.path = path
+        self.reader = reader
+        self.block_size = block_size
+        self._lock = threading.RLock()  # reconcile is called by allocate too
+        self._next = 0
+        self._end = 0  # first id after leased block
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+    def _read(self):
+        """
+        :return: State file content, file is replaced atomically, so no lock is needed just to read it
+        """
+        state = {'next': 1, 'rows': 0}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as state_file:
+                state.update(json.loads(state_file.read()))
+        return state
+
+    @contextmanager
+    def _state(self):
+        """
+        Lock state file for other processes and yield its content, which is saved on exit
+        """
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                yield state
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as state_file:
+                    state_file.write(json.dumps(state))
+                    state_file.flush()
+                    os.fsync(state_file.fileno())
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reconcile(self):
+        """
+        Sync counter with the sheet: read only new rows of id column and move counter past max id in the sheet
+        State file is locked only to merge the result, not during the request
+        """
+        offset = self._read()['rows']
+        max_id, rows = self.reader(offset)
+        with self._lock:
+            with self._state() as state:
+                state['next'] = max(state['next'], max_id + 1)
+                state['rows'] = max(state['rows'], offset + rows)  # other process could read further meanwhile
+                state['reconciled'] = True
+            if max_id >= self._next:  # rest of leased block is already used in the sheet
+                self._end = self._next
+
+    def reserve(self, order_id):
+        """
+        Mark ids up to order_id as used (e.g. orders waiting in journal)
+        """
+        with self._state() as state:
+            state['next'] = max(state['next'], order_id + 1)
+
+    def allocate(self, count=1):
+        """
+        Waits for the sheet only if the state file was never reconciled, otherwise ids could repeat ones in the sheet
+        :param count: Number of contiguous ids
+        :return: First of new order ids
+        """
+        with self._lock:
+            if self._end - self._next < count:  # only local state, reconcile is done by background jobs
+                state = self._read()
+                if not state.get('reconciled') and not state['rows']:  # new state file knows nothing about the sheet
+                    self.reconcile()
+                with self._state() as state:
+                    if state['next'] == self._end:  # rest of current block can't be used, return it
+                        state['next'] = self._next
+                    self._next = state['next']
+                    self._end = self._next + max(self.block_size, count)
+                    state['next'] = self._end
+            order_id = self._next
+            self._next += count
+            return order_id
+
+    def release(self):
+        """
+        Return unused ids of current block if nobody leased after it
+        """
+        with self._lock:
+            if self._next >= self._end:
+                return
+            with self._state() as state:
+                if state['next'] == self._end:
+                    state['next'] = self._next
+            self._end = self._next
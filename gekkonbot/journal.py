@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import threading
+from .metrics import metrics, SIZE_BUCKETS
+
+
+FLUSH_INTERVAL = 5  # seconds
+BATCH_SIZE = 50
+JOURNAL_NAME = 'orders.journal'  # file name in data dir, worker processes use orders.<number>.journal
+
+
+class OrderJournal:
+    """
+    Durable append-only journal of order rows (write-behind buffer for orders sheet)
+    Rows are written to local file first and flushed to the sheet in batches by background thread
+    """
+
+    def __init__(self, path, writer, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        """
+        :param path: Path to journal file
+        :param writer: Callable, which writes list of rows to the sheet
+        :param batch_size: Flush as soon as this many rows are pending
+        :param flush_interval: Max time (seconds) row waits in journal
+        """
+        self.path = path
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []  # rows not yet written to the sheet
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._file = None
+        self.replay()
+
+    def replay(self):
+        """
+        Load unflushed rows left from previous run
+        :return: List of pending rows
+        """
+        flushed = set()
+        orders = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # torn write after crash
+                        continue
+                    if 'order' in entry:
+                        orders.append(entry['order'])
+                    elif 'flushed' in entry:
+                        flushed.update(entry['flushed'])
+        self._pending = [row for row in orders if row[0] not in flushed]
+        self._compact()
+        if len(self._pending):
+            print("Replaying {} unflushed orders from journal".format(len(self._pending)))
+        return self._pending
+
+    def _compact(self):
+        """
+        Rewrite journal with pending rows only
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if self._file is not None:
+            self._file.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as tmp_file:
+            for row in self._pending:
+                tmp_file.write(json.dumps({'order': row}, ensure_ascii=False) + '\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _write(self, *entries):
+        self._file.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def put(self, *rows):
+        """
+        Durably store rows, they are flushed to the sheet together. Returns as soon as rows are on disk
+        :param rows: Sheet rows, first cell is order id
+        """
+        with self._condition:
+            self._write(*[{'order': row} for row in rows])
+            self._pending.extend(rows)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def pending(self):
+        """
+        :return: List of rows waiting for flush
+        """
+        with self._condition:
+            return list(self._pending)
+
+    def flush(self):
+        """
+        Write all pending rows to the sheet with single request
+        :return: Number of written rows
+        """
+        with self._condition:
+            batch = list(self._pending)
+        if not len(batch):
+            return 0
+        self.writer(batch)
+        metrics.observe('orders_batch_size', len(batch), buckets=SIZE_BUCKETS)
+        with self._condition:
+            self._write({'flushed': [row[0] for row in batch]})
+            self._pending = self._pending[len(batch):]
+            if not len(self._pending):
+                self._compact()
+        return len(batch)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                if self._running and len(self._pending) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                running = self._running
+            try:
+                self.flush()
+            except Exception as e:
+                print("Can't flush orders journal: ", e)
+                if running:
+                    time.sleep(self.flush_interval)
+            if not running:
+                break
+
+    def start(self):
+        """
+        Start background flusher
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="orders_journal", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop flusher and write rest of rows
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._file.close()
@@ -0,0 +1,192 @@
+import time
+import bisect
+import functools
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        :return: Upper bound of bucket containing q-quantile
+        """
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return 0
+
+
+class Metrics:
+    """
+    Registry of counters, histograms and gauges
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)  # (name, labels): value
+        self.histograms = {}  # (name, labels): Histogram
+        self.gauges = {}  # name: callable
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name, value, buckets=BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, func):
+        """
+        :param func: Callable, returns current value
+        """
+        self.gauges[name] = func
+
+    def timed(self, name, **labels):
+        """
+        Context manager, which observes duration of block and counts errors
+        """
+        return _Timer(self, name, labels)
+
+    def handler(self, func):
+        """
+        Decorator for handlers, observes handler_seconds and handler_errors_total
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.timed('handler', handler=func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def export(self):
+        """
+        :return: Metrics in Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda x: x[0])
+        for (name, labels), value in counters:
+            lines.append("gekkon_{}{} {}".format(name, format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            total = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                total += count
+                lines.append("gekkon_{}_bucket{} {}".format(name, format_labels(labels + (('le', bound),)), total))
+            lines.append("gekkon_{}_sum{} {}".format(name, format_labels(labels), histogram.sum))
+            lines.append("gekkon_{}_count{} {}".format(name, format_labels(labels), histogram.count))
+        for name, func in sorted(self.gauges.items()):
+            try:
+                lines.append("gekkon_{} {}".format(name, func()))
+            except Exception:  # source is not ready yet
+                continue
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        :return: Short human readable report
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items(), key=lambda x: x[0])
+            counters = sorted(self.counters.items())
+        for (name, labels), histogram in histograms:
+            if not histogram.count:
+                continue
+            lines.append("{}{}: n={} avg={:.3f} p95<={}".format(name, format_labels(labels), histogram.count,
+                                                               histogram.sum / histogram.count,
+                                                               histogram.quantile(0.95)))
+        for (name, labels), value in counters:
+            lines.append("{}{}: {}".format(name, format_labels(labels), value))
+        for name, func in sorted(self.gauges.items()):
+            try:
+                lines.append("{}: {}".format(name, func()))
+            except Exception:
+                continue
+        return "\n".join(lines)
+
+    def serve(self, listen, port):
+        """
+        Start HTTP endpoint with metrics in background thread
+        :return: HTTPServer
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.export().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((listen, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name + '_seconds', time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None:
+            self.metrics.inc(self.name + '_errors_total', **self.labels)
+        return False
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in labels) + "}"
+
+
+metrics = Metrics()
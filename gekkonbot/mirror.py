@@ -0,0 +1,195 @@
+import json
+import sqlite3
+import threading
+import datetime as dt
+
+
+STATUS_COLUMNS = slice(6, 10)  # G:J, filled by production, order is closed when the last one is filled
+STATUS_COUNT = STATUS_COLUMNS.stop - STATUS_COLUMNS.start
+ORDER_COLUMNS = 13  # A:M, as written by OrderList.new_batch
+TIME_FORMAT = "%d.%m.%Y %H:%M:%S"
+GROUP_COLUMNS = {'item': ('code', 'name'), 'destination': ('destination',), 'employee': ('customer',)}
+
+
+def get_order_id(row):
+    """
+    :param row: Row of orders sheet
+    :return: Order id or None for header and empty rows
+    """
+    if not len(row) or not str(row[0]).isdigit():
+        return None
+    return int(row[0])
+
+
+class OrdersMirror:
+    """
+    Local SQLite copy of orders sheet
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path to database file
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY, sheet_row INTEGER, "
+                         "code TEXT, name TEXT, count TEXT, customer TEXT, created TEXT, status TEXT, "
+                         "deadline TEXT, destination TEXT, comment TEXT, closed INTEGER DEFAULT 0, "
+                         "customer_id INTEGER, day TEXT)")
+        try:  # databases created before customer ids were stored
+            self._db.execute("ALTER TABLE orders ADD COLUMN customer_id INTEGER")
+        except sqlite3.OperationalError:
+            pass
+        try:  # databases created before reports, day is filled from creation time
+            self._db.execute("ALTER TABLE orders ADD COLUMN day TEXT")
+            self._db.execute("UPDATE orders SET day = substr(created, 7, 4) || '-' || substr(created, 4, 2) || '-' || "
+                             "substr(created, 1, 2) WHERE length(created) >= 10")
+        except sqlite3.OperationalError:
+            pass
+        self._db.execute("CREATE INDEX IF NOT EXISTS orders_day ON orders (day)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS orders_customer ON orders (customer, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS orders_customer_id ON orders (customer_id, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS orders_open ON orders (closed, sheet_row)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS orders_row ON orders (sheet_row)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self._db.commit()
+
+    @staticmethod
+    def _status(values):
+        return [str(x) for x in values] + [''] * (STATUS_COUNT - len(values))
+
+    @staticmethod
+    def _day(created):
+        """
+        :return: ISO date of order creation time or None
+        """
+        try:
+            return dt.datetime.strptime(str(created), TIME_FORMAT).date().isoformat()
+        except ValueError:
+            return None
+
+    @classmethod
+    def _values(cls, row, sheet_row, customer_id):
+        row = list(row) + [''] * (ORDER_COLUMNS - len(row))
+        status = cls._status(row[STATUS_COLUMNS])
+        return (int(row[0]), sheet_row, str(row[1]), row[2], str(row[3]), row[4], row[5], json.dumps(status),
+                row[10], row[11], row[12], int(bool(status[-1])), customer_id, cls._day(row[5]))
+
+    def add(self, rows, first_row=None, customer_id=None):
+        """
+        Insert orders or set sheet row numbers of known ones
+        Status of known orders is changed only by update_statuses, so changes are not missed
+        :param rows: Order rows as in the sheet
+        :param first_row: Sheet row number of first row, None for orders not yet written to the sheet
+        :param customer_id: Telegram user id of customer, known only for orders placed by this bot
+        """
+        with self._lock, self._db:
+            self._insert(rows, first_row, customer_id)
+
+    def _insert(self, rows, first_row, customer_id):
+        values = []
+        for i, row in enumerate(rows):
+            if get_order_id(row) is None:
+                continue
+            values.append(self._values(row, None if first_row is None else first_row + i, customer_id))
+        self._db.executemany("INSERT INTO orders (id, sheet_row, code, name, count, customer, created, status, "
+                             "deadline, destination, comment, closed, customer_id, day) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT(id) DO UPDATE SET sheet_row = COALESCE(excluded.sheet_row, sheet_row)",
+                             values)
+
+    def rescan(self, rows, first_row):
+        """
+        Replace sheet row numbers of all orders after rows were deleted or moved in the sheet
+        :param rows: All order rows of the sheet
+        :param first_row: Sheet row number of first row
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE orders SET sheet_row = NULL WHERE sheet_row IS NOT NULL")
+            self._insert(rows, first_row, None)
+
+    def id_at(self, sheet_row):
+        """
+        :return: Id of order in sheet row or None
+        """
+        row = self._db.execute("SELECT id FROM orders WHERE sheet_row = ?", (sheet_row,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_meta(self, key, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def open_rows(self, start=0, limit=-1):
+        """
+        :param start: First sheet row number
+        :param limit: Max number of rows, -1 for all
+        :return: Sorted sheet row numbers of not closed orders
+        """
+        rows = self._db.execute("SELECT sheet_row FROM orders WHERE closed = 0 AND sheet_row >= ? "
+                                "ORDER BY sheet_row LIMIT ?", (start, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def update_statuses(self, first_row, ids, statuses, count):
+        """
+        Compare status columns with last seen ones, rows with unexpected order id are skipped
+        :param first_row: Sheet row number of first status
+        :param ids: Rows of id column, trailing empty rows may be omitted
+        :param statuses: Rows of status columns, trailing empty rows may be omitted
+        :param count: Number of rows in requested range
+        :return: (list of (id, customer id, item name, count, status) of changed orders,
+                  True if some rows hold other orders than expected, i.e. rows were moved in the sheet)
+        """
+        ids = list(ids) + [[]] * (count - len(ids))
+        statuses = list(statuses) + [[]] * (count - len(statuses))
+        known = self._db.execute("SELECT sheet_row, id, customer_id, name, count, status FROM orders "
+                                 "WHERE sheet_row BETWEEN ? AND ? AND closed = 0",
+                                 (first_row, first_row + count - 1)).fetchall()
+        changed = []
+        moved = False
+        with self._lock, self._db:
+            for sheet_row, order_id, customer_id, name, item_count, last_status in known:
+                if get_order_id(ids[sheet_row - first_row]) != order_id:
+                    moved = True
+                    continue
+                status = self._status(statuses[sheet_row - first_row])
+                dump = json.dumps(status)
+                if dump == last_status:
+                    continue
+                self._db.execute("UPDATE orders SET status = ?, closed = ? WHERE id = ?",
+                                 (dump, int(bool(status[-1])), order_id))
+                changed.append((order_id, customer_id, name, item_count, status))
+        return changed, moved
+
+    def by_customer(self, customer_id, customer, limit=10):
+        """
+        :param customer_id: Telegram user id of customer
+        :param customer: Customer name, used only for orders without customer id (e.g. added to the sheet by hand)
+        :return: List of latest orders (id, name, count, created, status list)
+        """
+        rows = self._db.execute("SELECT id, name, count, created, status FROM orders "
+                                "WHERE customer_id = ? OR (customer_id IS NULL AND customer = ?) "
+                                "ORDER BY id DESC LIMIT ?", (customer_id, customer, limit)).fetchall()
+        return [(order_id, name, count, created, json.loads(status)) for order_id, name, count, created, status in rows]
+
+    def totals(self, group, first_day, last_day):
+        """
+        Number of orders and sum of items counts grouped by item, destination or employee
+        :param group: Key of GROUP_COLUMNS
+        :param first_day: First date (datetime.date) of range
+        :param last_day: Last date of range
+        :return: List of (*group values, orders, items), biggest first
+        """
+        columns = ", ".join(GROUP_COLUMNS[group])
+        return self._db.execute("SELECT {0}, COUNT(*) AS orders, SUM(CAST(count AS INTEGER)) AS items FROM orders "
+                                "WHERE day BETWEEN ? AND ? GROUP BY {0} ORDER BY items DESC, orders DESC".format(columns),
+                                (first_day.isoformat(), last_day.isoformat())).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,125 @@
+import time
+import queue
+import threading
+from telegram import ParseMode
+from telegram.error import BadRequest, ChatMigrated, RetryAfter, Unauthorized
+from .metrics import metrics
+
+
+QUEUE_SIZE = 1000
+WORKERS = 2
+RETRIES = 5
+BACKOFF = 1  # seconds, doubled after each failure
+CHAT_INTERVAL = 3  # seconds between messages to one chat (Telegram allows ~20 messages per minute in groups)
+GLOBAL_INTERVAL = 1 / 30  # seconds between any messages (Telegram allows ~30 messages per second)
+
+
+class Notifier:
+    """
+    Sends notifications from background workers, so handlers don't wait for Telegram
+    """
+
+    def __init__(self, bot, workers=WORKERS, size=QUEUE_SIZE, chat_interval=CHAT_INTERVAL):
+        """
+        :param bot: telegram.Bot
+        :param workers: Number of sending threads
+        :param size: Max number of queued messages
+        :param chat_interval: Min time (seconds) between messages to one chat
+        """
+        self.bot = bot
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self._queue = queue.Queue(maxsize=size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._chat_next = {}  # chat_id: timestamp when next message is allowed
+        self._global_next = 0
+
+    def notify(self, text, chat_ids):
+        """
+        Queue message for every chat without waiting
+        :param text: Markdown text
+        :param chat_ids: Iterable of chat ids
+        """
+        for chat_id in set(chat_ids):
+            try:
+                self._queue.put_nowait((chat_id, text))
+            except queue.Full:
+                print("Notification queue is full, message to {} dropped".format(chat_id))
+                metrics.inc('notifications_dropped_total')
+
+    def depth(self):
+        """
+        :return: Number of queued messages
+        """
+        return self._queue.qsize()
+
+    def _wait_turn(self, chat_id):
+        """
+        Sleep until message to chat_id fits into rate limits
+        """
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._chat_next.get(chat_id, 0), self._global_next)
+            self._chat_next[chat_id] = send_at + self.chat_interval
+            self._global_next = send_at + GLOBAL_INTERVAL
+        if send_at > now:
+            time.sleep(send_at - now)
+
+    def _delay_chat(self, chat_id, delay):
+        with self._lock:
+            self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0), time.monotonic() + delay)
+
+    def send(self, chat_id, text):
+        """
+        Send message with retries
+        :return: True if message was delivered
+        """
+        backoff = BACKOFF
+        for attempt in range(RETRIES):
+            self._wait_turn(chat_id)
+            try:
+                with metrics.timed('notification'):
+                    self.bot.send_message(text=text, chat_id=chat_id, parse_mode=ParseMode.MARKDOWN)
+                return True
+            except RetryAfter as e:
+                self._delay_chat(chat_id, e.retry_after)
+            except ChatMigrated as e:
+                chat_id = e.new_chat_id
+            except (BadRequest, Unauthorized) as e:  # retrying won't help
+                print("Can't send message to {}: {}".format(chat_id, e))
+                metrics.inc('notifications_dropped_total')
+                return False
+            except Exception as e:
+                print("Can't send message to {} (attempt {}): {}".format(chat_id, attempt + 1, e))
+                self._delay_chat(chat_id, backoff)
+                backoff *= 2
+        print("Message to {} dropped after {} attempts".format(chat_id, RETRIES))
+        metrics.inc('notifications_dropped_total')
+        return False
+
+    def _loop(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            self.send(*task)
+
+    def start(self):
+        """
+        Start sending threads
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name="notifier_{}".format(i), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """
+        Send queued messages and stop threads
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
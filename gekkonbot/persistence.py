@@ -0,0 +1,140 @@
+import json
+import time
+import sqlite3
+import threading
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+
+
+CONVERSATION_TTL = 60 * 60 * 24  # 1 day, in seconds
+PERSISTENCE_GROUP = 100  # handlers group, which runs after all others
+
+
+class Persistence:
+    """
+    Storage for conversation states and user_data
+    """
+
+    def load_conversations(self, name):
+        """
+        :param name: Conversation name
+        :return: Dict {key: state}
+        """
+        raise NotImplementedError
+
+    def save_conversation(self, name, key, state):
+        """
+        :param state: New state, None if conversation is over
+        """
+        raise NotImplementedError
+
+    def load_user_data(self):
+        """
+        :return: Dict {user_id: user_data}
+        """
+        raise NotImplementedError
+
+    def save_user_data(self, user_id, data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLitePersistence(Persistence):
+    """
+    Keeps states in local SQLite database, every change is written as separate row update
+    """
+
+    def __init__(self, path, ttl=CONVERSATION_TTL):
+        """
+        :param path: Path to database file
+        :param ttl: Conversations and user_data untouched for longer time are not restored
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._saved = {}  # user_id: last saved user_data json
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS conversations "
+                         "(name TEXT, key TEXT, state TEXT, updated REAL, PRIMARY KEY (name, key))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS user_data "
+                         "(user_id INTEGER PRIMARY KEY, data TEXT, updated REAL)")
+        self._db.commit()
+
+    def _expire(self, table):
+        self._db.execute("DELETE FROM {} WHERE updated < ?".format(table), (time.time() - self.ttl,))
+
+    def load_conversations(self, name):
+        with self._lock, self._db:
+            self._expire('conversations')
+            rows = self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    def save_conversation(self, name, key, state):
+        with self._lock, self._db:
+            if state is None:
+                self._db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                                 (name, json.dumps(key), json.dumps(state), time.time()))
+
+    def load_user_data(self):
+        with self._lock, self._db:
+            self._expire('user_data')
+            rows = self._db.execute("SELECT user_id, data FROM user_data").fetchall()
+        self._saved = dict(rows)
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def save_user_data(self, user_id, data):
+        dump = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+        if self._saved.get(user_id) == dump:  # nothing changed
+            return
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO user_data VALUES (?, ?, ?)", (user_id, dump, time.time()))
+        self._saved[user_id] = dump
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class PersistentConversationHandler(ConversationHandler):
+    """
+    ConversationHandler, which writes every state change to persistence
+    """
+
+    def __init__(self, name, persistence, *args, **kwargs):
+        """
+        :param name: Conversation name, key in persistence
+        :param persistence: Persistence
+        """
+        super(PersistentConversationHandler, self).__init__(*args, **kwargs)
+        self.name = name
+        self.persistence = persistence
+        self.conversations.update(persistence.load_conversations(name))
+
+    def update_state(self, new_state, key):
+        super(PersistentConversationHandler, self).update_state(new_state, key)
+        if new_state is None:  # state is not changed
+            return
+        state = self.conversations.get(key)
+        if not isinstance(state, tuple):  # tuple means state is pending in async handler
+            self.persistence.save_conversation(self.name, key, state)
+
+
+def setup_persistence(dispatcher, persistence):
+    """
+    Restore user_data and save it after every update
+    :param dispatcher: telegram.ext.Dispatcher
+    :param persistence: Persistence
+    """
+    dispatcher.user_data.update(persistence.load_user_data())
+
+    def save_user_data(bot, update):
+        user = update.effective_user
+        if user is not None and user.id in dispatcher.user_data:
+            persistence.save_user_data(user.id, dispatcher.user_data[user.id])
+
+    dispatcher.add_handler(TypeHandler(Update, save_user_data), group=PERSISTENCE_GROUP)
@@ -0,0 +1,82 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+RECENT_SIZE = 6  # per user
+MAX_USERS = 5000  # least recently active users are forgotten above this
+
+
+class RecentStore:
+    """
+    Per-user recent destinations, items and last order, kept in memory and saved to SQLite
+    """
+
+    def __init__(self, path, size=RECENT_SIZE, max_users=MAX_USERS, owner=None):
+        """
+        :param path: Path to database file
+        :param size: Max number of recent destinations and items of one user
+        :param max_users: Max number of users in memory and database (per process)
+        :param owner: Callable(user_id), True for users handled by this process, None if all users are
+        """
+        self.size = size
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS recent (user_id INTEGER PRIMARY KEY, data TEXT, updated REAL)")
+        self._db.commit()
+        rows = self._db.execute("SELECT user_id, data FROM recent ORDER BY updated DESC").fetchall()
+        rows = [row for row in rows if owner is None or owner(row[0])][:max_users]
+        self._users = OrderedDict((user_id, json.loads(data)) for user_id, data in reversed(rows))
+
+    def _get(self, user_id):
+        return self._users.get(user_id, {'destinations': [], 'items': [], 'last': None})
+
+    def destinations(self, user_id):
+        """
+        :return: List of destination hashes, most recent first
+        """
+        return list(self._get(user_id)['destinations'])
+
+    def items(self, user_id):
+        """
+        :return: List of item codes, most recent first
+        """
+        return list(self._get(user_id)['items'])
+
+    def last_order(self, user_id):
+        """
+        :return: Dict {'item': code, 'destination': hash} or None
+        """
+        return self._get(user_id)['last']
+
+    def _push(self, values, value):
+        if value in values:
+            values.remove(value)
+        values.insert(0, value)
+        del values[self.size:]
+
+    def add_order(self, user_id, item_code, destination_hash):
+        """
+        Remember order of user
+        """
+        with self._lock:
+            data = self._users.pop(user_id, None) or self._get(user_id)
+            self._push(data['destinations'], destination_hash)
+            self._push(data['items'], item_code)
+            data['last'] = {'item': item_code, 'destination': destination_hash}
+            self._users[user_id] = data
+            evicted = []
+            while len(self._users) > self.max_users:
+                evicted.append(self._users.popitem(last=False)[0])
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO recent VALUES (?, ?, ?)",
+                                 (user_id, json.dumps(data), time.time()))
+                self._db.executemany("DELETE FROM recent WHERE user_id = ?", [(x,) for x in evicted])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,136 @@
+import os
+import re
+import hmac
+import gzip
+import hashlib
+import json
+import time
+import threading
+from telegram import Update
+from telegram.ext import TypeHandler
+
+
+RECORD_GROUP = -2  # before flood control, so dropped updates are recorded too
+KEPT_TEXT_RE = re.compile(r"^(/[a-z_]+(@\w+)?( \S+)*|[0-9.,:\s]*)$")  # commands, counts and dates
+MESSAGE_FIELDS = ('message_id', 'text', 'entities')
+CALLBACK_FIELDS = ('id', 'data')
+INLINE_FIELDS = ('id', 'query', 'offset')
+ID_BYTES = 5  # anonymous ids are below 2^40, collisions are unlikely for thousands of users
+
+
+class UpdateRecorder:
+    """
+    Writes incoming updates with their arrival time to gzipped JSON lines file
+    Users and chats get ids hashed with secret salt, which is kept next to the recording,
+    so ids are the same after restarts of the bot; names and free text are removed
+    """
+
+    def __init__(self, path, keep_text=False):
+        """
+        :param path: Path to recording, new records are appended
+        :param keep_text: Keep free text of messages and inline queries (e.g. destination search)
+        """
+        self.path = path
+        self.keep_text = keep_text
+        self._lock = threading.Lock()
+        self._salt = self._load_salt(path + '.salt')
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    @staticmethod
+    def _load_salt(path):
+        """
+        :return: Salt of the recording, new one is created for new recording
+        """
+        if not os.path.exists(path):
+            with open(path, 'w') as salt_file:
+                salt_file.write(os.urandom(16).hex())
+        with open(path, 'r') as salt_file:
+            return bytes.fromhex(salt_file.read().strip())
+
+    def _id(self, real_id):
+        digest = hmac.new(self._salt, str(real_id).encode(), hashlib.sha256).digest()
+        anonymous_id = int.from_bytes(digest[:ID_BYTES], 'big') + 1
+        return anonymous_id if real_id > 0 else -anonymous_id  # groups have negative ids
+
+    def _user(self, user):
+        user_id = self._id(user['id'])
+        return {'id': user_id, 'first_name': "User{}".format(user_id), 'username': "user{}".format(user_id),
+                'is_bot': user.get('is_bot', False)}
+
+    def _text(self, text):
+        if self.keep_text or KEPT_TEXT_RE.match(text):
+            return text
+        return 'x' * len(text)
+
+    def _message(self, message):
+        result = {key: message[key] for key in MESSAGE_FIELDS if key in message}
+        result['date'] = 0
+        result['chat'] = {'id': self._id(message['chat']['id']), 'type': message['chat']['type']}
+        if message.get('from'):  # empty in messages of bot
+            result['from'] = self._user(message['from'])
+        if 'text' in result:
+            result['text'] = self._text(result['text'])
+        return result
+
+    def anonymize(self, data):
+        """
+        :param data: Update dictionary
+        :return: Anonymized copy or None for update types, which are not recorded
+        """
+        if 'message' in data:
+            return {'message': self._message(data['message'])}
+        if 'callback_query' in data:
+            query = data['callback_query']
+            result = {key: query[key] for key in CALLBACK_FIELDS if key in query}
+            result['from'] = self._user(query['from'])
+            result['chat_instance'] = str(result['from']['id'])  # real one is a stable id of chat too
+            if query.get('message'):
+                result['message'] = self._message(query['message'])
+            return {'callback_query': result}
+        if 'inline_query' in data:
+            query = data['inline_query']
+            result = {key: query[key] for key in INLINE_FIELDS if key in query}
+            result['from'] = self._user(query['from'])
+            result['query'] = self._text(result.get('query', ''))
+            return {'inline_query': result}
+        return None
+
+    def record(self, bot, update):
+        """
+        Handler of all updates
+        """
+        with self._lock:
+            data = self.anonymize(update.to_dict())
+            if data is None:
+                return
+            self._file.write(json.dumps({'t': round(time.time(), 3), 'u': data}, ensure_ascii=False,
+                                        separators=(',', ':')) + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def setup_recorder(dispatcher, recorder):
+    """
+    :param dispatcher: telegram.ext.Dispatcher
+    :param recorder: UpdateRecorder
+    """
+    dispatcher.add_handler(TypeHandler(Update, recorder.record), group=RECORD_GROUP)
+
+
+def read_recording(path):
+    """
+    :param path: Path to recording
+    :return: Iterator of (arrival time, update dictionary)
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as recording:
+        try:
+            for line in recording:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # torn write after crash
+                    continue
+                yield entry['t'], entry['u']
+        except EOFError:  # file was not closed properly
+            pass
@@ -0,0 +1,80 @@
+import io
+import csv
+import datetime as dt
+from .mirror import GROUP_COLUMNS
+
+
+DATE_FORMAT = "%d.%m.%Y"
+TOP_ROWS = 10  # rows of each group in message
+GROUP_TITLES = {'item': "По позициям", 'destination': "По площадкам", 'employee': "По сотрудникам"}
+
+
+def parse_date(text, today):
+    """
+    :param text: Date in format 23.02.2024 or 23.02 (current year)
+    :param today: datetime.date, year of short dates is taken from it
+    :return: datetime.date
+    """
+    if text.count('.') == 1:
+        text = "{}.{}".format(text, today.year)
+    return dt.datetime.strptime(text, DATE_FORMAT).date()
+
+
+def parse_period(args, today):
+    """
+    :param args: [first date, [last date]], current month if empty
+    :param today: datetime.date
+    :return: (first date, last date)
+    """
+    if not len(args):
+        return today.replace(day=1), today
+    first_day = parse_date(args[0], today)
+    last_day = parse_date(args[1], today) if len(args) > 1 else today
+    if last_day < first_day:
+        raise ValueError("Wrong period: {} - {}".format(first_day, last_day))
+    return first_day, last_day
+
+
+def get_report(mirror, first_day, last_day, groups=tuple(GROUP_COLUMNS)):
+    """
+    :param mirror: OrdersMirror
+    :param groups: Keys of GROUP_COLUMNS
+    :return: Dict {group: [(*group values, orders, items)]}
+    """
+    return {group: mirror.totals(group, first_day, last_day) for group in groups}
+
+
+def format_key(group, row):
+    if group == 'item':
+        return "[{}] {}".format(row[0], row[1])
+    return str(row[0])
+
+
+def format_text(report, first_day, last_day, top=TOP_ROWS):
+    """
+    :return: Report message with top rows of every group
+    """
+    rows = next(iter(report.values()))
+    lines = ["Отчет за {:%d.%m.%Y} - {:%d.%m.%Y}: заказов {}, позиций {} шт".format(
+        first_day, last_day, sum(row[-2] for row in rows), sum(row[-1] or 0 for row in rows))]
+    for group, rows in report.items():
+        lines.append("")
+        lines.append("{}:".format(GROUP_TITLES[group]))
+        for row in rows[:top]:
+            lines.append("{} - {} заказов, {} шт".format(format_key(group, row), row[-2], row[-1] or 0))
+        if len(rows) > top:
+            lines.append("... еще {}".format(len(rows) - top))
+    return "\n".join(lines)
+
+
+def format_csv(report):
+    """
+    :return: CSV with all rows of all groups (bytes)
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["group", "key", "orders", "items"])
+    for group, rows in report.items():
+        for row in rows:
+            writer.writerow([group, format_key(group, row), row[-2], row[-1] or 0])
+    return output.getvalue().encode('utf-8-sig')  # BOM makes Excel read UTF-8
@@ -0,0 +1,183 @@
+import time
+import random
+import threading
+import httplib2
+from .metrics import metrics
+
+
+READ_QUOTA = 60  # requests per minute, default Sheets API quota per user
+WRITE_QUOTA = 60
+RETRIES = 5
+BACKOFF = 1  # seconds, doubled after each failure
+MAX_BACKOFF = 32
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = (OSError, ConnectionError, httplib2.HttpLib2Error)  # e.g. DNS failure raises ServerNotFoundError
+READ_METHODS = ('get', 'batchGet')
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per minute with bursts up to `rate`
+    """
+
+    def __init__(self, rate):
+        self.capacity = rate
+        self.tokens = rate
+        self.per_second = rate / 60
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Take token if available
+        :return: 0 on success, otherwise seconds until token is available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_second)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.per_second
+
+
+class Flight:
+    """
+    Request being executed, identical reads wait for its result
+    """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestScheduler:
+    """
+    Executes Sheets requests within quotas: retries failed requests with backoff,
+    merges identical concurrent reads and lets reads go before writes
+    """
+
+    def __init__(self, client, read_quota=READ_QUOTA, write_quota=WRITE_QUOTA, retries=RETRIES):
+        """
+        :param client: SheetsClient
+        :param read_quota: Read requests per minute
+        :param write_quota: Write requests per minute
+        :param retries: Max number of retries of one request
+        """
+        self.client = client
+        self.service = client.service
+        self.retries = retries
+        self._condition = threading.Condition()
+        self._buckets = {True: TokenBucket(read_quota), False: TokenBucket(write_quota)}  # is read: bucket
+        self._reads_waiting = 0
+        self._paused_until = 0  # set after 429
+        self._flights = {}  # request key: Flight
+        self.degraded_since = None  # timestamp of first failure, None while Sheets is available
+        self.last_error = None
+        self.on_health_change = None  # Callable(degraded), called when Sheets becomes unavailable or recovers
+
+    @staticmethod
+    def is_read(request):
+        return getattr(request, 'methodId', '').rsplit('.', 1)[-1] in READ_METHODS
+
+    @staticmethod
+    def key(request):
+        return getattr(request, 'methodId', None), getattr(request, 'uri', None), getattr(request, 'body', None)
+
+    def _acquire(self, read):
+        """
+        Wait for quota token, writes wait while there are reads in the queue
+        """
+        with self._condition:
+            if read:
+                self._reads_waiting += 1
+            try:
+                while True:
+                    delay = self._paused_until - time.monotonic()
+                    if delay <= 0 and (read or not self._reads_waiting):
+                        delay = self._buckets[read].take()
+                        if delay == 0:
+                            return
+                    self._condition.wait(delay if delay > 0 else None)
+            finally:
+                if read:
+                    self._reads_waiting -= 1
+                    self._condition.notify_all()
+
+    def _pause(self, delay):
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def _set_health(self, error):
+        """
+        :param error: Exception, after which request was given up, or None after successful request
+        """
+        with self._condition:
+            changed = (error is None) != (self.degraded_since is None)
+            if error is not None:
+                self.last_error = error
+                if self.degraded_since is None:
+                    self.degraded_since = time.time()
+            else:
+                self.degraded_since = None
+        if changed:
+            print("Google Sheets is {}".format("unavailable: {}".format(error) if error is not None else "available"))
+            if self.on_health_change is not None:
+                self.on_health_change(error is not None)
+
+    def _execute(self, request, read):
+        backoff = BACKOFF
+        for attempt in range(self.retries + 1):
+            self._acquire(read)
+            try:
+                response = self.client.execute(request)
+                if self.degraded_since is not None:
+                    self._set_health(None)
+                return response
+            except Exception as e:
+                status = getattr(getattr(e, 'resp', None), 'status', None)
+                retriable = status in RETRY_STATUSES or (status is None and isinstance(e, TRANSIENT_ERRORS))
+                if retriable and attempt == self.retries:  # Sheets is unavailable, not just bad request
+                    self._set_health(e)
+                if not retriable or attempt == self.retries:
+                    raise
+                delay = min(backoff, MAX_BACKOFF) * (1 + random.random())  # full jitter on top of backoff
+                metrics.inc('sheets_retries_total', status=status)
+                print("Sheets request failed ({}), retry in {:.1f}s".format(status or e, delay))
+                if status == 429:  # quota is exhausted for everybody
+                    self._pause(delay)
+                else:
+                    time.sleep(delay)
+                backoff *= 2
+
+    def execute(self, request):
+        """
+        :param request: apiclient HttpRequest
+        :return: Response
+        """
+        read = self.is_read(request)
+        if not read:
+            return self._execute(request, read)
+        key = self.key(request)
+        with self._condition:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            metrics.inc('sheets_coalesced_total')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._execute(request, read)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._condition:
+                del self._flights[key]
+            flight.done.set()
@@ -0,0 +1,128 @@
+import re
+import bisect
+from collections import defaultdict
+
+
+TOKEN_RE = re.compile(r"\w+")
+EXACT_SCORE = 3
+PREFIX_SCORE = 2
+SUBSTRING_SCORE = 1
+TYPO_SCORE = 0.5
+
+
+def tokenize(text):
+    """
+    :param text: Any text
+    :return: List of lowercase words
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+def trigrams(token):
+    """
+    :param token: Word
+    :return: Set of trigrams of padded word
+    """
+    padded = " {} ".format(token)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """
+    Levenshtein distance, stops early when it exceeds limit
+    :return: Distance or limit + 1
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class SearchIndex:
+    """
+    Inverted index over short texts with ranked results
+    Rank of query word: exact word > word prefix > substring of word > word with typo
+    """
+
+    def __init__(self, texts):
+        """
+        :param texts: List of indexed texts, results are positions in this list
+        """
+        self._postings = defaultdict(set)  # token: {document}
+        for i, text in enumerate(texts):
+            for token in tokenize(text):
+                self._postings[token].add(i)
+        self._tokens = sorted(self._postings)
+        self._trigrams = defaultdict(set)  # trigram: {token}
+        for token in self._tokens:
+            for trigram in trigrams(token):
+                self._trigrams[trigram].add(token)
+
+    def _prefixed(self, prefix):
+        start = bisect.bisect_left(self._tokens, prefix)
+        for token in self._tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def _similar(self, word):
+        """
+        :return: Tokens sharing trigrams with word (candidates for substring and typo matches)
+        """
+        candidates = set()
+        for trigram in trigrams(word):
+            candidates.update(self._trigrams.get(trigram, ()))
+        return candidates
+
+    def match(self, word):
+        """
+        :param word: Lowercase query word
+        :return: Dict {document: score}
+        """
+        matched = {}  # token: score
+        if word in self._postings:
+            matched[word] = EXACT_SCORE
+        for token in self._prefixed(word):
+            matched.setdefault(token, PREFIX_SCORE)
+        candidates = self._similar(word) if len(word) >= 3 else self._tokens
+        for token in candidates:
+            if token not in matched and word in token:
+                matched[token] = SUBSTRING_SCORE
+        if not matched and len(word) >= 4:
+            limit = 1 if len(word) < 8 else 2
+            for token in self._similar(word):
+                if edit_distance(word, token, limit) <= limit:
+                    matched[token] = TYPO_SCORE
+        scores = {}
+        for token, score in matched.items():
+            for document in self._postings[token]:
+                if scores.get(document, 0) < score:
+                    scores[document] = score
+        return scores
+
+    def search(self, query):
+        """
+        :param query: Search query, every word of it must match
+        :return: List of documents, best first
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        total = None
+        for word in words:
+            scores = self.match(word)
+            if total is None:
+                total = scores
+            else:
+                total = {document: total[document] + score for document, score in scores.items()
+                         if document in total}
+            if not total:
+                return []
+        return sorted(total, key=lambda document: (-total[document], document))
@@ -0,0 +1,138 @@
+import os
+import re
+import time
+import queue as queues
+import signal
+import threading
+import multiprocessing
+from telegram import Update
+from .journal import JOURNAL_NAME
+
+
+QUEUE_SIZE = 1000  # updates waiting for one worker process
+PARENT_POLL = 1  # seconds, how often worker checks that main process is alive
+SHARD_JOURNAL_RE = re.compile(r"^orders\.([0-9]+)\.journal$")
+
+
+def shard_of(user_id, count):
+    """
+    :param user_id: Telegram user id, None for updates without user
+    :param count: Number of worker processes
+    :return: Index of worker process, which handles all updates of user
+    """
+    return 0 if user_id is None else user_id % count
+
+
+def get_journals(data_dir, shard):
+    """
+    Every process writes its own orders journal, the first one also flushes journals left by processes,
+    which are not running anymore (e.g. after number of processes was decreased)
+    :param data_dir: Directory for local data
+    :param shard: (index, count) of worker process or None for single process
+    :return: (journal file name, list of orphaned journal paths)
+    """
+    if shard is None:
+        name, count = JOURNAL_NAME, 0
+    else:
+        name, count = 'orders.{}.journal'.format(shard[0]), shard[1]
+    if shard is not None and shard[0] != 0:
+        return name, []
+    orphans = []
+    for file_name in sorted(os.listdir(data_dir)):
+        match = SHARD_JOURNAL_RE.match(file_name)
+        if (match and int(match.group(1)) >= count) or (file_name == JOURNAL_NAME and name != JOURNAL_NAME):
+            orphans.append(os.path.join(data_dir, file_name))
+    return name, orphans
+
+
+class ShardRouter:
+    """
+    Receives updates in main process and passes them to worker processes by user id,
+    so conversation of one user is always handled by the same process
+    """
+
+    def __init__(self, config, processes, queue_size=QUEUE_SIZE):
+        """
+        :param config: Config dictionary, passed to workers
+        :param processes: Number of worker processes
+        :param queue_size: Max number of updates waiting for one worker
+        """
+        context = multiprocessing.get_context('spawn')  # main process already runs threads, don't fork them
+        self.queues = [context.Queue(maxsize=queue_size) for i in range(processes)]
+        self.processes = [context.Process(target=run_worker, args=(config, (i, processes), queue),
+                                          name="worker-{}".format(i))
+                          for i, queue in enumerate(self.queues)]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def route(self, bot, update):
+        """
+        Handler of main process dispatcher
+        """
+        user = update.effective_user
+        shard = shard_of(user.id if user is not None else None, len(self.queues))
+        self.queues[shard].put(update.to_dict())
+
+    def stop(self, signum=None, frame=None):
+        """
+        Let workers handle queued updates, flush their journals and exit
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def run_worker(config, shard, queue):
+    """
+    Worker process: handles updates routed to it until None is received
+    :param config: Config dictionary
+    :param shard: (index, count) of this process
+    :param queue: multiprocessing.Queue of update dicts
+    """
+    from .bot import init, stop_services
+    # signals are sent to the whole process group (Ctrl+C, systemd), main process stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    parent = os.getppid()
+    updater = init(config, shard=shard)
+    dispatcher = updater.dispatcher
+    updater.job_queue.start()
+    thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    thread.start()
+    print("Worker {} of {} started".format(shard[0] + 1, shard[1]))
+    while True:
+        try:
+            data = queue.get(timeout=PARENT_POLL)
+        except queues.Empty:
+            if os.getppid() != parent:  # main process was killed and can't stop workers
+                break
+            continue
+        if data is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(data, updater.bot))
+    while not dispatcher.update_queue.empty():  # let dispatcher take the rest of updates
+        time.sleep(0.1)
+    updater.job_queue.stop()
+    dispatcher.stop()
+    thread.join()
+    stop_services(None, None)
+
+
+def init_router(config, processes):
+    """
+    Start worker processes and create updater of main process, which only passes updates to them
+    :param config: Config dictionary
+    :param processes: Number of worker processes
+    :return: Updater object
+    """
+    from telegram.ext import Updater, TypeHandler
+    from .bot import get_request_kwargs
+    router = ShardRouter(config, processes, queue_size=config.get('process-queue-size', QUEUE_SIZE))
+    router.start()
+    updater = Updater(config['telegram-token'], request_kwargs=get_request_kwargs(config),
+                      user_sig_handler=router.stop)
+    updater.dispatcher.add_handler(TypeHandler(Update, router.route))
+    return updater
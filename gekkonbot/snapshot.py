@@ -0,0 +1,61 @@
+import os
+import json
+
+
+FORMAT_VERSION = 1  # snapshots of other format are ignored
+
+
+class SnapshotFile:
+    """
+    Rows of cached sheets saved on disk after every successful load: bot starts from it before any network
+    request and keeps working from it while Google Sheets is unavailable. It is also shared by all bot processes:
+    one process reads the sheets and others reload rows from file when it changes
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path to snapshot file
+        """
+        self.path = path
+        self._mtime = None  # of last loaded or saved file
+
+    def save(self, sheets):
+        """
+        :param sheets: Dict {name: CachedSpreadsheet}
+        """
+        data = {
+            'format': FORMAT_VERSION,
+            'sheets': {name: {'rows': sheet.rows, 'timestamp': sheet.last_update} for name, sheet in sheets.items()}
+        }
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as snapshot_file:
+            snapshot_file.write(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def load(self, sheets):
+        """
+        Load rows into sheets if file was changed since last load or save
+        :param sheets: Dict {name: CachedSpreadsheet}
+        :return: True if file was loaded
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as snapshot_file:
+                data = json.loads(snapshot_file.read())
+        except ValueError as e:
+            print("Can't read snapshot: ", e)
+            return False
+        if data.get('format') != FORMAT_VERSION or any(name not in data['sheets'] for name in sheets):
+            return False
+        for name, sheet in sheets.items():
+            sheet.load(data['sheets'][name]['rows'], data['sheets'][name]['timestamp'])
+        self._mtime = mtime
+        return True
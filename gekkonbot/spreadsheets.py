@@ -1,99 +1,303 @@
-import httplib2
-import apiclient
+import os
+import sys
+import json
 import re
+import queue
+import threading
 import datetime as dt
 import hashlib
-from oauth2client import service_account
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .journal import OrderJournal, BATCH_SIZE, FLUSH_INTERVAL, JOURNAL_NAME
+from .ids import IdAllocator, ID_BLOCK_SIZE
+from .mirror import OrdersMirror, get_order_id
+from .search import SearchIndex
+from .metrics import metrics
 
 
 DISCOVERY_URL = "https://sheets.googleapis.com/$discovery/rest?version=v4"
-UPDATE_DELAY = 1000 * 60 * 30  # 30 minutes
-RECENT_SIZE = 6
+DISCOVERY_TIMEOUT = 10  # seconds
+DISCOVERY_MAX_AGE = 60 * 60 * 24  # 1 day, in seconds
+POOL_SIZE = 8
+UPDATE_DELAY = 60 * 30  # 30 minutes, in seconds
+MIRROR_DELAY = 60 * 5  # 5 minutes, in seconds
+WATCH_ROWS = 2000  # open orders, which statuses are read per sync
+WATCH_GAP = 20  # closed rows between open orders, which are read within one range instead of splitting it
 MSK_TZ = dt.timezone(dt.timedelta(hours=3))
 
 
+class SheetsClient:
+    """
+    Google Sheets API service shared by all sheets
+    Discovery document is cached on disk, requests are executed on pooled authorized connections
+    """
+    def __init__(self, credentials, data_dir, pool_size=POOL_SIZE):
+        """
+        :param credentials: ServiceAccountCredentials
+        :param data_dir: Directory for discovery document cache
+        :param pool_size: Number of HTTP connections
+        """
+        import httplib2
+        from apiclient import discovery  # heavy, imported only when real client is needed
+        self.credentials = credentials
+        self._pool = queue.LifoQueue()  # LIFO to reuse warm keep-alive connections first
+        for i in range(pool_size):
+            self._pool.put(credentials.authorize(httplib2.Http()))
+        document = self.load_discovery(os.path.join(data_dir, 'sheets_discovery.json'))
+        http = self._pool.get()
+        try:
+            self.service = discovery.build_from_document(document, http=http)
+        finally:
+            self._pool.put(http)
+
+    @staticmethod
+    def load_discovery(path):
+        """
+        Read cached discovery document, download it if cache is missing or outdated
+        :param path: Path to cached document
+        :return: Discovery document (string)
+        """
+        import httplib2
+        if os.path.exists(path) and dt.datetime.now().timestamp() - os.path.getmtime(path) < DISCOVERY_MAX_AGE:
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                return cache_file.read()
+        try:
+            response, content = httplib2.Http(timeout=DISCOVERY_TIMEOUT).request(DISCOVERY_URL)
+            if response.status != 200:
+                raise IOError("HTTP {}".format(response.status))
+            document = content.decode('utf-8')
+        except Exception as e:
+            if not os.path.exists(path):
+                raise
+            print("Can't download discovery document, using cached copy: ", e)
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                return cache_file.read()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as cache_file:
+            cache_file.write(document)
+        os.replace(path + '.tmp', path)
+        return document
+
+    def execute(self, request):
+        """
+        Execute request on free connection from the pool
+        :param request: apiclient HttpRequest
+        :return: Response
+        """
+        method = getattr(request, 'methodId', 'unknown')
+        http = self._pool.get()
+        try:
+            with metrics.timed('sheets_request', method=method):
+                return request.execute(http=http)
+        finally:
+            self._pool.put(http)
+
+
 class SpreadsheetService:
     """
     Provides service to work with Google Spreadsheets
     """
-    def __init__(self, credentials):
-        self._http = credentials.authorize(httplib2.Http())
-        self.service = apiclient.discovery.build('sheets', 'v4', http=self._http, discoveryServiceUrl=DISCOVERY_URL)
+    def __init__(self, client):
+        """
+        :param client: SheetsClient
+        """
+        self.client = client
+        self.service = client.service
 
 
-class ItemsCatalog(SpreadsheetService):
+class CachedSpreadsheet(SpreadsheetService):
     """
-    Provides list of available items for requesting
+    Keeps last good snapshot of a sheet range in memory
+    Snapshot is reloaded by refresh() (from background job) and replaced atomically
     """
-
-    def __init__(self, credentials, table_config):
+    def __init__(self, client, table_config):
         """
-        :param credentials: ServiceAccountCredentials
-        :param table_id: Id of Google Spreadsheet
+        :param client: SheetsClient
+        :param table_config: Table config dictionary
         """
-        super(ItemsCatalog, self).__init__(credentials)
+        super(CachedSpreadsheet, self).__init__(client)
         self.spreadsheet_id = table_config['table']
         self.range = table_config['sheet'] + "!" + table_config['range']
-        self._cache = {}
+        self._cache = []
+        self.rows = []  # rows snapshot was parsed from
+        self._digest = None  # digest of rows
+        self._refresh_lock = threading.Lock()
         self.last_update = 0  # timestamp
-        self.all()  # to preload catalog
+        self.version = 0  # incremented on every snapshot change
+        self.loaded = threading.Event()  # set after the first load
 
-    def all(self):
+    def refresh(self):
         """
-        :return: Dict of items {code: (name, description)}
+        Reload sheet and swap snapshot. Does nothing if another refresh is in progress
+        :return: True if snapshot was changed
         """
-        now = dt.datetime.now().timestamp()
-        if now - self.last_update > UPDATE_DELAY:
+        if not self._refresh_lock.acquire(blocking=False):
+            metrics.inc('cache_refresh_skipped_total', sheet=type(self).__name__)
+            return False
+        metrics.inc('cache_refresh_total', sheet=type(self).__name__)
+        try:
+            now = dt.datetime.now().timestamp()
             query = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=self.range)
-            response = query.execute()
-            rows = response.get('values', [])
-            self._cache = []
-            category_name = "Unnamed category"
-            category_items = {}
-
-            for i, row in enumerate(rows):
-                if len(row) > 0:
-                    if row[0]:  # category header
-                        if len(category_items) > 0:
-                            self._cache.append({
-                                'title': category_name,
-                                'items': category_items
-                            })
-                        category_name = row[0].split(":")[-1].strip()
-                        category_items = {}
-                    elif len(row) < 3:
-                        print("No name in row #{}".format(i + 2))
-                        continue
-                    else:
-                        if not row[2]:  # skip subitem
-                            continue
-                        try:
-                            code = int(row[1])
-                            name_search = re.search('"([^"]+)"', row[2])
-                            if name_search:
-                                category_items[code] = (name_search.group(1), row[2])
-                            else:
-                                category_items[code] = (row[2], row[2])
-                        except ValueError:  # no code
-                            print("No code in row #{}".format(i + 2))
-                            continue
-
-            if len(category_items) > 0:
-                self._cache.append({
-                    'title': category_name,
-                    'items': category_items
-                })
-            self.last_update = now
+            response = self.client.execute(query)
+            return self.load(response.get('values', []), now)
+        finally:
+            self._refresh_lock.release()
+
+    def load(self, rows, timestamp):
+        """
+        Replace snapshot with parsed rows, keep it (and its version) if rows are not changed
+        :param rows: Rows of sheet range
+        :param timestamp: Time, when rows were read
+        :return: True if snapshot was changed
+        """
+        digest = rows_digest(rows)
+        self.last_update = timestamp
+        self.rows = rows
+        if digest == self._digest:
+            metrics.inc('cache_refresh_unchanged_total', sheet=type(self).__name__)
+            return False
+        self._cache = self.parse(rows)
+        self._digest = digest
+        self.version += 1
+        self.loaded.set()
+        return True
+
+    def parse(self, rows):
+        """
+        :param rows: Rows of sheet range
+        :return: New snapshot
+        """
+        raise NotImplementedError
+
+    def all(self):
+        """
+        :return: Last loaded snapshot
+        """
         return self._cache
 
+
+class Item(namedtuple('Item', ('code', 'name', 'description'))):
+    """
+    Catalog item
+    """
+    __slots__ = ()
+
+
+class Category:
+    """
+    Catalog category
+    """
+    __slots__ = ('title', 'items', 'list', 'digest')
+
+    def __init__(self, title, items, digest):
+        """
+        :param title: Category title
+        :param items: List of items
+        :param digest: Digest of category rows
+        """
+        self.title = title
+        self.items = {item.code: item for item in items}
+        self.list = tuple(items)
+        self.digest = digest
+
+
+class Catalog:
+    """
+    Snapshot of catalog
+    """
+    __slots__ = ('categories', 'by_code', 'by_digest', 'entries', 'index')
+
+    def __init__(self, categories):
+        """
+        :param categories: List of categories
+        """
+        self.categories = categories
+        self.by_code = {}  # code: category id
+        self.entries = []  # [(category id, Item)]
+        for i, category in enumerate(categories):
+            for item in category.list:
+                self.by_code.setdefault(item.code, i)
+                self.entries.append((i, item))
+        self.by_digest = {category.digest: category for category in categories}
+        self.index = SearchIndex(["{} {} {}".format(item.code, item.name, item.description)
+                                  for i, item in self.entries])
+
+
+class ItemsCatalog(CachedSpreadsheet):
+    """
+    Provides list of available items for requesting
+    """
+
+    def __init__(self, client, table_config):
+        """
+        :param client: SheetsClient
+        :param table_config: Table config dictionary
+        """
+        super(ItemsCatalog, self).__init__(client, table_config)
+        self._cache = Catalog([])
+
+    def parse(self, rows):
+        """
+        Parse rows, categories with unchanged rows are taken from previous snapshot
+        :param rows: Rows of Nomenclature sheet
+        :return: Catalog
+        """
+        previous = self._cache
+        categories = []
+        for first_row, block in split_categories(rows):
+            digest = rows_digest(block)
+            category = previous.by_digest.get(digest)
+            if category is None:
+                category = self.parse_category(first_row, block, digest)
+            if len(category.list) > 0:
+                categories.append(category)
+        return Catalog(categories)
+
+    @staticmethod
+    def parse_category(first_row, rows, digest):
+        """
+        :param first_row: Number of first row in sheet
+        :param rows: Rows of category, header is first (if any)
+        :param digest: Digest of rows
+        :return: Category
+        """
+        category_name = "Unnamed category"
+        items = {}
+        for i, row in enumerate(rows, first_row):
+            if len(row) > 0:
+                if row[0]:  # category header
+                    category_name = row[0].split(":")[-1].strip()
+                elif len(row) < 3:
+                    print("No name in row #{}".format(i))
+                    continue
+                else:
+                    if not row[2]:  # skip subitem
+                        continue
+                    try:
+                        code = int(row[1])
+                        description = sys.intern(row[2])
+                        name_search = re.search('"([^"]+)"', row[2])
+                        if name_search:
+                            items[code] = Item(code, sys.intern(name_search.group(1)), description)
+                        else:
+                            items[code] = Item(code, description, description)
+                    except ValueError:  # no code
+                        print("No code in row #{}".format(i))
+                        continue
+        return Category(sys.intern(category_name), list(items.values()), digest)
+
+    def all(self):
+        """
+        :return: List of categories
+        """
+        return self._cache.categories
+
     def get_category(self, category):
         """
         :param category: Category number
         :return: Items list from category
         """
-        catalog = self.all()
-        subcatalog = [(code,) + tuple(catalog[category]['items'][code]) for code in catalog[category]['items']]
-        return subcatalog
+        return self.all()[category].list
 
     def get(self, category, code):
         """
@@ -101,17 +305,32 @@ class ItemsCatalog(SpreadsheetService):
         :param code: Item code
         :return: Item
         """
-        catalog = self.all()
-        item = (code,) + tuple(catalog[category]['items'][code])
-        return item
+        return self.all()[category].items[code]
+
+    def find(self, code):
+        """
+        :param code: Item code
+        :return: (category id, Item)
+        """
+        snapshot = self._cache
+        category = snapshot.by_code[code]
+        return category, snapshot.categories[category].items[code]
+
+    def search(self, query):
+        """
+        :param query: Search query (words of name, description or code)
+        :return: List of (category id, Item), best matches first
+        """
+        snapshot = self._cache
+        return [snapshot.entries[i] for i in snapshot.index.search(query)]
 
     def get_categories(self):
         """
         :return: List of categories
         """
         categories = []
-        for i, category in enumerate(self._cache):
-            categories.append((i, category['title']))
+        for i, category in enumerate(self.all()):
+            categories.append((i, category.title))
         return categories
 
 
@@ -120,105 +339,319 @@ class OrderList(SpreadsheetService):
     Provides storage for orders
     """
 
-    def __init__(self, credentials, table_config):
+    def __init__(self, client, table_config, data_dir, journal_name=JOURNAL_NAME, orphans=()):
         """
-        :param credentials: ServiceAccountCredentials
-        :param table_id: Id of Google Spreadsheet
+        :param client: SheetsClient
+        :param table_config: Table config dictionary
+        :param data_dir: Directory for orders journal, ids state and local copy of orders
+        :param journal_name: File name of orders journal
+        :param orphans: Paths of journals left by other processes, their orders are flushed too
         """
-        super(OrderList, self).__init__(credentials)
+        super(OrderList, self).__init__(client)
         self.spreadsheet_id = table_config['table']
+        self.sheet = table_config['sheet']
         self.range = table_config['sheet'] + "!" + table_config['range']
-        self.id_range = table_config['sheet'] + "!" + table_config['id-range']
-        self.last_id = 0
-        self.get_last_id()
+        id_column, id_start = re.match(r"([A-Z]+)([0-9]+)", table_config['id-range']).groups()
+        self.id_column = id_column
+        self.id_start = int(id_start)
+        self.mirror = OrdersMirror(os.path.join(data_dir, 'orders.sqlite3'))
+        self.watch_rows = table_config.get('watch-rows', WATCH_ROWS)
+        self.watch_gap = table_config.get('watch-gap', WATCH_GAP)
+        self._sync_lock = threading.Lock()
+        self.ids = IdAllocator(os.path.join(data_dir, 'order_ids.json'), self.get_last_id,
+                               block_size=table_config.get('id-block-size', ID_BLOCK_SIZE))
+        self.journals = [OrderJournal(path, self.append, batch_size=table_config.get('batch-size', BATCH_SIZE),
+                                      flush_interval=table_config.get('flush-interval', FLUSH_INTERVAL))
+                         for path in [os.path.join(data_dir, journal_name)] + list(orphans)]
+        self.journal = self.journals[0]
+        for journal in self.journals:
+            for row in journal.pending():  # unflushed orders are not in the sheet yet
+                self.ids.reserve(int(row[0]))
+            journal.start()
 
-    def get_last_id(self):
+    def get_last_id(self, offset=0):
         """
-        Find max id in first column
+        Find max id in first column, reading only rows after offset
+        :param offset: Number of already checked rows
+        :return: (max id, number of read rows)
         """
-        query = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=self.id_range)
-        response = query.execute()
-        column = [x[0] for x in response.get('values', [['0']]) if len(x)]
-        self.last_id = max(map(int, column))
+        start = self.id_start + offset
+        id_range = "{}!{}{}:{}".format(self.sheet, self.id_column, start, self.id_column)
+        query = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=id_range)
+        response = self.client.execute(query)
+        rows = response.get('values', [])
+        column = [int(x[0]) for x in rows if len(x) and x[0].isdigit()]
+        return max(column, default=0), len(rows)
 
-    def new(self, item, count, customer, deadline, destination, comment):
+    def new(self, item, count, customer, deadline, destination, comment, customer_id=None):
         """
+        Put order into journal, it will be written to the sheet by journal flusher
         :param item: Item code
         :param count: Items count
         :param customer: Customer name
         :param deadline: Deadline date
         :param destination: Destination school
         :param comment: Purpose for order
-        :return:
+        :param customer_id: Telegram user id of customer, who is notified about status changes
+        :return: Order id
+        """
+        return self.new_batch([(item, count)], customer, deadline, destination, comment, customer_id)[0]
+
+    def new_batch(self, lines, customer, deadline, destination, comment, customer_id=None):
+        """
+        Put several orders with contiguous ids into journal, they are written to the sheet with single request
+        :param lines: List of (item, count)
+        :param customer: Customer name
+        :param deadline: Deadline date
+        :param destination: Destination school
+        :param comment: Purpose for order
+        :param customer_id: Telegram user id of customer, who is notified about status changes
+        :return: List of order ids
         """
         time = dt.datetime.now(tz=MSK_TZ).strftime("%d.%m.%Y %H:%M:%S")
-        self.last_id += 1
-        order_id = "{:05}".format(self.last_id)
+        first_id = self.ids.allocate(len(lines))
+        rows = []
+        for i, (item, count) in enumerate(lines):
+            rows.append(["{:05}".format(first_id + i), item[0], item[1], count, customer, time, '', '', '', '',
+                         deadline, destination, comment])
+        self.journal.put(*rows)
+        self.mirror.add(rows, customer_id=customer_id)
+        return [row[0] for row in rows]
+
+    def sync(self):
+        """
+        Update local copy of orders: read rows added to the sheet since last sync
+        and status columns of orders, which are not closed yet
+        :return: List of (id, customer id, item name, count, status) of orders with changed status
+        """
+        if not self._sync_lock.acquire(blocking=False):  # sync is already running
+            return []
+        try:
+            synced = self.mirror.get_meta('synced-rows', 0)
+            start = self.id_start + max(synced - 1, 0)  # last synced row is read again to check it is still there
+            rows = self.read_rows(start)
+            if synced and get_order_id(rows[0] if len(rows) else []) != self.mirror.id_at(start):
+                self.rescan()
+            else:
+                self.mirror.add(rows, first_row=start)
+                self.mirror.set_meta('synced-rows', start - self.id_start + len(rows))
+            return self.watch_statuses()
+        finally:
+            self._sync_lock.release()
+
+    def read_rows(self, start):
+        """
+        :param start: Number of first sheet row
+        :return: Order rows from start to the end of the sheet
+        """
+        tail_range = "{}!A{}:M".format(self.sheet, start)
+        query = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=tail_range)
+        return self.client.execute(query).get('values', [])
+
+    def rescan(self):
+        """
+        Read all rows again after rows were deleted or moved in the sheet, so row numbers of orders are shifted
+        """
+        print("Rows of orders sheet were moved, reading the whole sheet")
+        metrics.inc('orders_rescans_total')
+        rows = self.read_rows(self.id_start)
+        self.mirror.rescan(rows, self.id_start)
+        self.mirror.set_meta('synced-rows', len(rows))
+        self.mirror.set_meta('status-cursor', 0)
+
+    def watch_statuses(self):
+        """
+        Read ids and status columns of at most watch-rows open orders with single request and find changed ones
+        Next call continues from the row where previous one stopped, so every open order is checked in turn
+        :return: List of (id, customer id, item name, count, status) of orders with changed status
+        """
+        cursor = self.mirror.get_meta('status-cursor', 0)
+        rows = self.mirror.open_rows(cursor, self.watch_rows)
+        if len(rows) < self.watch_rows:  # reached the end, wrap around
+            rows = [x for x in self.mirror.open_rows(0, self.watch_rows - len(rows)) if x < cursor] + rows
+            self.mirror.set_meta('status-cursor', 0)
+        else:
+            self.mirror.set_meta('status-cursor', rows[-1] + 1)
+        spans = get_spans(rows, self.watch_gap)
+        if not len(spans):
+            return []
+        ranges = []
+        for first, last in spans:  # ids are read too, to check that rows still hold the same orders
+            ranges += ["{}!A{}:A{}".format(self.sheet, first, last), "{}!G{}:J{}".format(self.sheet, first, last)]
+        query = self.service.spreadsheets().values().batchGet(spreadsheetId=self.spreadsheet_id, ranges=ranges)
+        value_ranges = self.client.execute(query).get('valueRanges', [])
+        changed = []
+        moved = False
+        for i, (first, last) in enumerate(spans):
+            ids, statuses = value_ranges[2 * i:2 * i + 2]
+            span_changed, span_moved = self.mirror.update_statuses(first, ids.get('values', []),
+                                                                   statuses.get('values', []), last - first + 1)
+            changed += span_changed
+            moved = moved or span_moved
+        if moved:  # skipped rows are checked again after row numbers are fixed
+            self.rescan()
+        return changed
+
+    def append(self, rows):
+        """
+        Write rows to the sheet with single request
+        :param rows: List of rows
+        """
         body = {
-            'values': [[order_id, item[0], item[1], count, customer, time, '', '', '', '', deadline, destination, comment]]
+            'values': rows
         }
         query = self.service.spreadsheets().values().append(spreadsheetId=self.spreadsheet_id, range=self.range,
                                                             body=body, valueInputOption="RAW")
-        result = query.execute()
-        return order_id
+        self.client.execute(query)
 
+    def close(self):
+        """
+        Flush journals, stop their flushers and return unused ids
+        """
+        for journal in self.journals:
+            journal.stop()
+        self.ids.release()
+        self.mirror.close()
 
-class DestinationList(SpreadsheetService):
+
+class Destinations:
     """
-    Provides list of available destinations
+    Snapshot of destinations with lookup and search indexes
     """
+    __slots__ = ('items', 'by_hash', 'index')
 
-    def __init__(self, credentials, table_config):
-        super(DestinationList, self).__init__(credentials)
-        self.spreadsheet_id = table_config['table']
-        self.range = table_config['sheet'] + "!" + table_config['range']
-        self._cache = []
-        self.recent = []
-        self.last_update = 0  # timestamp
-        self.all()  # to preload destinations
+    def __init__(self, items):
+        """
+        :param items: List of destinations [(name, md5 hash)]
+        """
+        self.items = items
+        self.by_hash = {dst_hash: dst for dst, dst_hash in items}
+        self.index = SearchIndex([dst for dst, dst_hash in items])
 
-    def all(self):
-        now = dt.datetime.now().timestamp()
-        if now - self.last_update > UPDATE_DELAY:
-            query = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=self.range)
-            response = query.execute()
-            rows = response.get('values', [])
-            self._cache = []
-            for row in rows:
-                if not len(row):
-                    continue
-                md5 = hashlib.new('md5')
-                md5.update(row[0].encode('utf-8'))
-                self._cache.append((row[0], md5.hexdigest()))
-            self.last_update = now
-        return self._cache
 
-    def get_recent(self):
-        return self.recent
+class DestinationList(CachedSpreadsheet):
+    """
+    Provides list of available destinations
+    """
 
-    def update_recent(self, dst_hash):
-        for i in range(len(self.recent)):
-            if self.recent[i][1] == dst_hash:
-                self.recent.pop(i)
-                break
-        self.recent.insert(0, (self.get(dst_hash), dst_hash))
-        if len(self.recent) > RECENT_SIZE:
-            self.recent = self.recent[:RECENT_SIZE]
+    def __init__(self, client, table_config):
+        """
+        :param client: SheetsClient
+        :param table_config: Table config dictionary
+        """
+        super(DestinationList, self).__init__(client, table_config)
+        self._cache = Destinations([])
+
+    def parse(self, rows):
+        """
+        :param rows: Rows of destinations sheet
+        :return: Destinations snapshot
+        """
+        destinations = []
+        for row in rows:
+            if not len(row):
+                continue
+            md5 = hashlib.new('md5')
+            md5.update(row[0].encode('utf-8'))
+            destinations.append((row[0], md5.hexdigest()))
+        return Destinations(destinations)
+
+    def all(self):
+        """
+        :return: List of destinations [(name, md5 hash)]
+        """
+        return self._cache.items
 
     def get(self, query_hash):
-        for dst, dst_hash in self._cache:
-            if dst_hash == query_hash:
-                return dst
-        raise IndexError
+        try:
+            return self._cache.by_hash[query_hash]
+        except KeyError:
+            raise IndexError
 
     def search(self, query):
-        destinations = self.all()
-        query = query.lower()
-        results = []
-        for dst, dst_hash in destinations:
-            if query in ' {} '.format(dst.lower()):
-                results.append((dst, dst_hash))
-        return results
+        """
+        :param query: Search query
+        :return: List of destinations [(name, md5 hash)], best matches first
+        """
+        snapshot = self._cache
+        return [snapshot.items[i] for i in snapshot.index.search(query)]
+
+
+def preload(client, sheets, tasks=()):
+    """
+    Load cached sheets concurrently, sheets of one spreadsheet are read with single batchGet request
+    :param client: SheetsClient
+    :param sheets: List of CachedSpreadsheet
+    :param tasks: Other callables to run along with loading
+    :return: Dict {sheet or task: Future}
+    """
+    groups = OrderedDict()
+    for sheet in sheets:
+        groups.setdefault(sheet.spreadsheet_id, []).append(sheet)
+    executor = ThreadPoolExecutor(max_workers=len(groups) + len(tasks))
+    futures = {}
+    for spreadsheet_id, group in groups.items():
+        future = executor.submit(load_batch, client, spreadsheet_id, group)
+        for sheet in group:
+            futures[sheet] = future
+    for task in tasks:
+        futures[task] = executor.submit(task)
+    executor.shutdown(wait=False)
+    return futures
+
+
+def load_batch(client, spreadsheet_id, sheets):
+    """
+    Read ranges of several sheets of one spreadsheet with single request and load them
+    :param client: SheetsClient
+    :param spreadsheet_id: Id of spreadsheet
+    :param sheets: List of CachedSpreadsheet
+    """
+    now = dt.datetime.now().timestamp()
+    query = client.service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id,
+                                                            ranges=[sheet.range for sheet in sheets])
+    response = client.execute(query)
+    for sheet, value_range in zip(sheets, response.get('valueRanges', [])):
+        sheet.load(value_range.get('values', []), now)
+
+
+def rows_digest(rows):
+    """
+    :param rows: Rows of sheet range
+    :return: Content digest
+    """
+    return hashlib.sha1(json.dumps(rows, ensure_ascii=False).encode('utf-8')).digest()
+
+
+def get_spans(rows, gap):
+    """
+    Merge sorted row numbers into ranges
+    :param rows: Sorted row numbers
+    :param gap: Max number of skipped rows inside one range
+    :return: List of (first row, last row)
+    """
+    spans = []
+    for row in rows:
+        if len(spans) and row - spans[-1][1] <= gap + 1:
+            spans[-1][1] = row
+        else:
+            spans.append([row, row])
+    return [tuple(span) for span in spans]
+
+
+def split_categories(rows):
+    """
+    Split catalog rows by category headers
+    :param rows: Rows of Nomenclature sheet
+    :return: Generator of (number of first row in sheet, rows)
+    """
+    start = 0
+    for i, row in enumerate(rows):
+        if i > start and len(row) > 0 and row[0]:
+            yield start + 2, rows[start:i]
+            start = i
+    if start < len(rows):
+        yield start + 2, rows[start:]
 
 
 def get_credentials(credentials_path):
@@ -226,5 +659,6 @@ def get_credentials(credentials_path):
     :param credentials_path: Path to credentials json file
     :return: ServiceAccountCredentials
     """
+    from oauth2client import service_account
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
     return service_account.ServiceAccountCredentials.from_json_keyfile_name(credentials_path, scopes=scopes)
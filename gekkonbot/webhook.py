@@ -0,0 +1,100 @@
+import ssl
+import hmac
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from telegram import Update
+from .metrics import metrics
+
+
+QUEUE_SIZE = 100
+WORKERS = 4
+MAX_BODY = 1024 * 1024  # bytes
+RETRY_AFTER = 1  # seconds, asked from Telegram when update queue is full
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP listener, which receives updates from Telegram and puts them straight into dispatcher queue
+    """
+    daemon_threads = True
+
+    def __init__(self, updater, listen, port, path, secret, queue_size=QUEUE_SIZE):
+        """
+        :param updater: telegram.ext.Updater
+        :param listen: Listen address
+        :param port: Listen port
+        :param path: URL path
+        :param secret: Secret token, Telegram sends it in every request
+        :param queue_size: Max number of updates waiting for dispatcher
+        """
+        super(WebhookServer, self).__init__((listen, port), WebhookHandler)
+        self.updater = updater
+        self.path = '/' + path.lstrip('/')
+        self.secret = secret
+        # bounded queue makes server answer 429 instead of piling up updates
+        self.update_queue = queue.Queue(maxsize=queue_size)
+        updater.update_queue = updater.dispatcher.update_queue = self.update_queue
+        metrics.gauge('update_queue_depth', self.update_queue.qsize)
+
+    def start(self, url, workers=WORKERS, cert=None, key=None):
+        """
+        Register webhook and start dispatcher, job queue and listener threads
+        :param url: Public URL of webhook
+        :param workers: Max number of simultaneous connections from Telegram
+        :param cert: Path to certificate, if TLS is not terminated by load balancer
+        :param key: Path to private key
+        """
+        if cert is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        updater = self.updater
+        updater.httpd = self  # Updater.stop() shuts it down
+        updater.running = True
+        updater.job_queue.start()
+        threading.Thread(target=updater.dispatcher.start, name="dispatcher").start()
+        threading.Thread(target=self.serve_forever, name="webhook").start()
+        certificate = open(cert, 'rb') if cert is not None else None
+        try:
+            updater.bot.set_webhook(url=url, certificate=certificate, max_connections=workers,
+                                    secret_token=self.secret)
+        finally:
+            if certificate is not None:
+                certificate.close()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def _reply(self, code, headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            return self._reply(404)
+        if server.secret and not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), server.secret):
+            return self._reply(403)
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_BODY:
+            return self._reply(413)
+        try:
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            update = Update.de_json(data, server.updater.bot)
+        except ValueError:
+            return self._reply(400)
+        try:
+            server.update_queue.put_nowait(update)
+        except queue.Full:  # Telegram will deliver it again later
+            metrics.inc('webhook_rejected_total')
+            return self._reply(429, [('Retry-After', str(RETRY_AFTER))])
+        self._reply(200)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import argparse
+import tempfile
+from collections import defaultdict
+from telegram import Bot
+from telegram.ext import ConversationHandler
+from gekkonbot import bot as gekkonbot
+from gekkonbot.fakes import FakeSheets, FakeTelegram
+from gekkonbot.recorder import read_recording
+from bench import TOKEN, Driver, make_tables, make_config, percentile
+
+
+MAX_GAP = 60  # seconds, longer pauses of recording (e.g. nights, restarts) are cut
+
+
+class HandlerProfiler:
+    """
+    Wraps callbacks of all registered handlers to profile and time every handler separately
+    """
+
+    def __init__(self):
+        self.profiles = defaultdict(cProfile.Profile)  # handler name: Profile
+        self.latencies = defaultdict(list)  # handler name: [seconds]
+
+    def wrap(self, handler):
+        callback = handler.callback
+        name = getattr(callback, '__name__', type(handler).__name__)
+
+        def wrapper(*args, **kwargs):
+            profile = self.profiles[name]
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.latencies[name].append(time.perf_counter() - start)
+        handler.callback = wrapper
+
+    def install(self, dispatcher):
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    nested = handler.entry_points + handler.fallbacks
+                    for state_handlers in handler.states.values():
+                        nested += state_handlers
+                    for nested_handler in nested:
+                        self.wrap(nested_handler)
+                else:
+                    self.wrap(handler)
+
+    def dump(self, directory):
+        """
+        Save profile of every handler, e.g. for snakeviz or flameprof
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, "{}.prof".format(name)))
+
+
+def load_tables(snapshot_path):
+    """
+    :param snapshot_path: Path to sheets snapshot saved by the bot
+    :return: Content of fake spreadsheets with the same catalog and destinations as in production
+    """
+    with open(snapshot_path, 'r', encoding='utf-8') as snapshot_file:
+        sheets = json.loads(snapshot_file.read())['sheets']
+    tables = make_tables(0, 0, 0)[0]
+    tables['catalog']['Номенклатура'] = [["header"]] + sheets['catalog']['rows']
+    tables['destinations']['Площадки'] = [["header"]] + sheets['destinations']['rows']
+    return tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates through bot handlers on fake Sheets and "
+                                                 "Telegram with per-handler profiles")
+    parser.add_argument('recording', help="file written by \"record\" option of the bot")
+    parser.add_argument('--snapshot', help="data/sheets.snapshot of the bot, synthetic catalog is used without it")
+    parser.add_argument('--speed', type=float, default=0, help="1 for real time, 10 for 10x faster, 0 for no pauses")
+    parser.add_argument('--profile-dir', default='profiles', help="directory for .prof files of handlers")
+    parser.add_argument('--sheets-latency', type=float, default=0, help="Sheets request latency, ms")
+    parser.add_argument('--telegram-latency', type=float, default=0, help="Telegram request latency, ms")
+    args = parser.parse_args()
+
+    tables = load_tables(args.snapshot) if args.snapshot else make_tables(20, 50, 3000)[0]
+    sheets = FakeSheets(tables, latency=args.sheets_latency / 1000)
+    telegram = FakeTelegram(latency=args.telegram_latency / 1000)
+    profiler = HandlerProfiler()
+    with tempfile.TemporaryDirectory() as data_dir:
+        updater = gekkonbot.init(make_config(data_dir), client=sheets, bot=Bot(TOKEN, request=telegram))
+        gekkonbot.dl.loaded.wait()
+        profiler.install(updater.dispatcher)
+        driver = Driver(updater)
+        start = time.perf_counter()
+        clock = 0  # recording time of current update, without cut pauses
+        previous = None
+        count = 0
+        for timestamp, data in read_recording(args.recording):
+            if previous is not None:
+                clock += min(max(timestamp - previous, 0), MAX_GAP)
+            previous = timestamp
+            if args.speed > 0:
+                delay = start + clock / args.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            driver.send(next(iter(data)), data)
+            count += 1
+        elapsed = time.perf_counter() - start
+        driver.stop()
+        gekkonbot.stop_services(None, None)
+
+    print("Updates: {} in {:.2f}s (recorded {:.0f}s)".format(count, elapsed, clock))
+    print("{:<28} {:>7} {:>9} {:>9} {:>9}".format("handler", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for name, latencies in sorted(profiler.latencies.items()):
+        latencies.sort()
+        print("{:<28} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format(name, len(latencies), percentile(latencies, 50) * 1000,
+                                                              percentile(latencies, 95) * 1000,
+                                                              percentile(latencies, 99) * 1000))
+    for kind, latencies in sorted(driver.latencies.items()):
+        latencies.sort()
+        print("{:<28} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format("update: " + kind, len(latencies),
+                                                              percentile(latencies, 50) * 1000,
+                                                              percentile(latencies, 95) * 1000,
+                                                              percentile(latencies, 99) * 1000))
+    profiler.dump(args.profile_dir)
+    print("Profiles saved to {}".format(args.profile_dir))
+    print("Sheets calls: {}".format(dict(sheets.calls)))
+    print("Telegram calls: {}".format(dict(telegram.calls)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
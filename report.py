@@ -0,0 +1,31 @@
+import os
+import sys
+import argparse
+import datetime as dt
+from gekkonbot.config import config
+from gekkonbot.mirror import OrdersMirror, GROUP_COLUMNS
+from gekkonbot.report import parse_period, get_report, format_text, format_csv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Totals of orders from local copy of orders sheet")
+    parser.add_argument('period', nargs='*', help="first and last date (23.02 or 23.02.2024), current month if empty")
+    parser.add_argument('--by', choices=sorted(GROUP_COLUMNS), action='append', help="group (all by default)")
+    parser.add_argument('--csv', help="write all rows to CSV file")
+    args = parser.parse_args()
+    try:
+        first_day, last_day = parse_period(args.period, dt.date.today())
+    except ValueError as e:
+        parser.error(str(e))
+    mirror = OrdersMirror(os.path.join(config['data-dir'], 'orders.sqlite3'))
+    report = get_report(mirror, first_day, last_day, groups=args.by or tuple(GROUP_COLUMNS))
+    mirror.close()
+    if args.csv:
+        with open(args.csv, 'wb') as csv_file:
+            csv_file.write(format_csv(report))
+    else:
+        print(format_text(report, first_day, last_day, top=sys.maxsize))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,21 @@
 from gekkonbot.bot import init
 from gekkonbot.config import config
+from gekkonbot.shards import init_router
+from gekkonbot.webhook import WebhookServer, WORKERS, QUEUE_SIZE
 
 
 if __name__ == '__main__':
-    updater = init(config)
+    if config.get('processes', 1) > 1:
+        updater = init_router(config, config['processes'])
+    else:
+        updater = init(config)
     print("Logged in as {}".format(updater.bot.get_me().name))
-    updater.start_polling()
+    if 'webhook' in config:
+        webhook = config['webhook']
+        server = WebhookServer(updater, webhook.get('listen', '0.0.0.0'), webhook['port'], webhook['path'],
+                               webhook.get('secret-token'), queue_size=webhook.get('queue-size', QUEUE_SIZE))
+        server.start(webhook['url'], workers=webhook.get('workers', WORKERS), cert=webhook.get('cert'),
+                     key=webhook.get('key'))
+    else:
+        updater.start_polling()
     updater.idle()
@@ -0,0 +1,90 @@
+import os
+import json
+import pytest
+from gekkonbot.ids import IdAllocator
+from gekkonbot.journal import OrderJournal
+
+
+class SheetIds:
+    """
+    Id column of orders sheet, read by IdAllocator
+    """
+
+    def __init__(self, ids=()):
+        self.ids = list(ids)
+        self.fail = False
+
+    def read(self, offset):
+        if self.fail:
+            raise OSError("network unreachable")
+        rows = self.ids[offset:]
+        return max(rows, default=0), len(rows)
+
+
+def test_allocate_reconciles_new_state(tmp_path):
+    sheet = SheetIds(range(1, 501))
+    ids = IdAllocator(str(tmp_path / 'ids.json'), sheet.read, block_size=5)
+    assert ids.allocate() == 501
+    assert ids.allocate(2) == 502
+
+
+def test_allocate_without_sheet_fails_for_new_state(tmp_path):
+    sheet = SheetIds(range(1, 501))
+    sheet.fail = True
+    ids = IdAllocator(str(tmp_path / 'ids.json'), sheet.read, block_size=5)
+    with pytest.raises(OSError):  # ids must not be allocated before the first reconcile
+        ids.allocate()
+
+
+def test_allocate_from_local_state_after_reconcile(tmp_path):
+    sheet = SheetIds(range(1, 11))
+    ids = IdAllocator(str(tmp_path / 'ids.json'), sheet.read, block_size=5)
+    ids.reconcile()
+    sheet.fail = True
+    assert [ids.allocate() for i in range(7)] == list(range(11, 18))
+
+
+def test_reconcile_drops_block_used_in_sheet(tmp_path):
+    sheet = SheetIds(range(1, 11))
+    ids = IdAllocator(str(tmp_path / 'ids.json'), sheet.read, block_size=5)
+    assert ids.allocate() == 11  # leases 11-15
+    sheet.ids += [11, 12, 13]  # 12 and 13 are added to the sheet by hand
+    ids.reconcile()
+    assert ids.allocate() == 16  # block is leased again after ids of other processes
+
+
+def test_allocators_share_state_file(tmp_path):
+    path = str(tmp_path / 'ids.json')
+    sheet = SheetIds(range(1, 11))
+    first = IdAllocator(path, sheet.read, block_size=3)
+    second = IdAllocator(path, sheet.read, block_size=3)
+    allocated = []
+    for i in range(5):
+        allocated.append(first.allocate())
+        first_id = second.allocate(2)
+        allocated += [first_id, first_id + 1]
+    assert len(set(allocated)) == len(allocated)
+    assert min(allocated) == 11
+    first.release()
+    second.release()
+    third = IdAllocator(path, sheet.read, block_size=3)
+    assert third.allocate() > max(allocated)
+
+
+def test_journal_replay_after_torn_write(tmp_path):
+    path = str(tmp_path / 'orders.journal')
+    written = []
+    journal = OrderJournal(path, written.extend)
+    journal.put(["00001", "a"], ["00002", "b"])
+    journal.flush()
+    journal.put(["00003", "c"])
+    journal._file.close()  # crash: the last write is torn
+    with open(path, 'a', encoding='utf-8') as journal_file:
+        journal_file.write(json.dumps({'order': ["00004", "d"]})[:10])
+
+    replayed = OrderJournal(path, written.extend)
+    assert replayed.pending() == [["00003", "c"]]
+    replayed.flush()
+    replayed.stop()
+    assert [row[0] for row in written] == ["00001", "00002", "00003"]
+    assert os.path.getsize(path) == 0